@@ -0,0 +1,133 @@
+import sys, os, time, glob, argparse, threading
+sys.path.insert(0, os.path.abspath('..'))
+
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from engine import SAVE_PRESETS, load_recipe, open_image, render_ops, set_workers, save_path, encode_image
+
+# applies an edit recipe (see recipe_ops in engine.py) to every image in a directory
+# without opening a window:
+#   $ python batch.py recipe.json images/ [output/] [--workers 4] [--preset 'jpeg web']
+# images stream through a pool of processes one file at a time, each worker only
+# ever holds the image it is working on, and results are saved next to the
+# originals (or in output/) with the _fotofix naming of Picture.save_image
+
+# files batch.py reads, outputs of earlier runs are skipped, see is_output
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp'}
+
+# files the home screen shows, in the order it shows them
+GALLERY_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# true for files fotofix wrote: name_fotofix.* and name_fotofix<extra>.*, where
+# extra comes from save_image or an export size, see save_path in engine.py
+def is_output(path):
+    return '_fotofix' in os.path.splitext(os.path.basename(path))[0]
+
+# image files in directory, sorted by name
+def list_images(directory):
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        extension = os.path.splitext(name)[1]
+        if extension.lower() in IMAGE_EXTENSIONS and not is_output(name):
+            paths.append(os.path.join(directory, name))
+    return paths
+
+# the photos of the home screen gallery
+def gallery_images(directory='./images'):
+    return [path for extension in GALLERY_EXTENSIONS for path in glob.glob(os.path.join(directory, '*' + extension))]
+
+# the edit log every worker process applies and the save preset it encodes with,
+# set once per process by start_worker
+worker_ops = None
+worker_preset = 'png'
+
+def start_worker(ops, preset='png'):
+    global worker_ops, worker_preset
+    worker_ops = ops
+    worker_preset = preset
+    # the pool already keeps every core busy, so banded operations stay on one thread
+    set_workers(1)
+
+# decodes, edits and encodes one file in a worker process
+# returns (path, output path, bytes read, bytes written, seconds, error)
+def edit_file(task):
+    path, output_dir = task
+    start = time.perf_counter()
+    try:
+        new_path, size, encode_time = encode_image(render_ops(open_image(path), worker_ops), save_path(path, preset=worker_preset, directory=output_dir), worker_preset)
+        return path, new_path, os.path.getsize(path), size, time.perf_counter() - start, None
+    except Exception as e:
+        return path, None, 0, 0, time.perf_counter() - start, "%s: %s" % (type(e).__name__, e)
+
+# applies ops to every file in paths on a pool of workers processes
+# yields the result of edit_file for every file as soon as it is done
+# raises BrokenProcessPool if a worker process dies, rather than waiting forever
+# for the file it had
+def run_batch(paths, ops, output_dir=None, workers=None, context=None, preset='png'):
+    workers = min(workers or os.cpu_count() or 1, max(len(paths), 1))
+    context = context or get_context()
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=start_worker, initargs=(ops, preset)) as pool:
+        tasks = [pool.submit(edit_file, (path, output_dir)) for path in paths]
+        for task in as_completed(tasks):
+            yield task.result()
+
+# run_batch on a background thread, returns the thread without waiting
+# on_result is called on that thread with the result of every file as it is done,
+# then on_finished(error) once the batch is over; error is None unless the pool
+# could not start or a worker died, files without a result by then never get one
+# the workers are spawned from a fresh interpreter, so they never inherit the
+# window or the threads of the app that starts them
+def start_batch(paths, ops, on_result, on_finished=None, output_dir=None, workers=None, preset='png'):
+    def run():
+        error = None
+        try:
+            for result in run_batch(paths, ops, output_dir, workers, get_context('spawn'), preset):
+                on_result(result)
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+            print("batch failed: %s" % error)
+        finally:
+            if on_finished is not None:
+                on_finished(error)
+
+    thread = threading.Thread(target=run, name='fotofix-batch', daemon=True)
+    thread.start()
+    return thread
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="apply an edit recipe to every image in a directory")
+    parser.add_argument('recipe', help="json edit recipe")
+    parser.add_argument('input_dir', help="directory of images to edit")
+    parser.add_argument('output_dir', nargs='?', help="where edited images go, by default next to the originals")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument('--preset', choices=list(SAVE_PRESETS), default='png', help="format and quality of the edited images")
+    args = parser.parse_args(argv)
+
+    try:
+        ops = load_recipe(args.recipe)
+    except ValueError as e:
+        parser.error("bad recipe %s: %s" % (args.recipe, e))
+    paths = list_images(args.input_dir)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    done = failed = read = written = 0
+    for path, new_path, size_in, size_out, seconds, error in run_batch(paths, ops, args.output_dir, args.workers, preset=args.preset):
+        if error is not None:
+            failed += 1
+            print("failed %s: %s" % (path, error))
+            continue
+        done += 1
+        read += size_in
+        written += size_out
+        print("%s -> %s  %6.3f s" % (path, new_path, seconds))
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print("batch %d images, %d failed, %d workers  %6.1f s  %5.1f images/s  %6.1f MB/s in  %6.1f MB/s out" % (
+        done, failed, args.workers, elapsed, done / elapsed, read / 2**20 / elapsed, written / 2**20 / elapsed))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,244 @@
+import sys, os, time, shutil, tempfile
+sys.path.insert(0, os.path.abspath('..'))
+
+from io import BytesIO
+import numpy as np
+from PIL import Image, ImageEnhance
+
+from engine import flood_fill_mask, similar_color_mask, fill_mask, tint_mask, grow_mask, mask_union, block_average
+from engine import render_ops, set_workers, pixelate_image, apply_point_ops, enhance, Pyramid
+from engine import RegionIndex, index_regions
+from engine import export_render, encode_image, fit_size
+
+# builds a synthetic RGBA photo with a noisy gradient background and a few
+# flat colored shapes, 6000 x 4000 is 24 megapixels
+def make_test_image(width=6000, height=4000, seed=0):
+    rng = np.random.default_rng(seed)
+    data = np.empty((height, width, 4), dtype=np.uint8)
+
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)
+    data[..., 0] = xs[None, :]
+    data[..., 1] = ys[:, None]
+    data[..., 2] = 128
+    data[..., 3] = 255
+    data[..., :3] += rng.integers(0, 8, (height, width, 3), dtype=np.uint8)
+
+    # flat "sky" band and a disc to select
+    data[:height//4, :, :3] = (90, 160, 230)
+    yy, xx = np.ogrid[:height, :width]
+    disc = (xx - width//2)**2 + (yy - height//2)**2 < (min(width, height)//4)**2
+    data[disc, :3] = (240, 40, 40)
+    return data
+
+# make_test_image with strong noise on top, so flat colors are rare and selections
+# are ragged, much like a real photo
+def make_textured_image(width=6000, height=4000, seed=0, noise=48):
+    data = make_test_image(width, height, seed)
+    rng = np.random.default_rng(seed + 1)
+    grain = rng.integers(-noise//2, noise//2 + 1, (height, width, 3), dtype=np.int16)
+    data[..., :3] = np.clip(data[..., :3] + grain, 0, 255)
+    return data
+
+# a photo from the gallery as an RGBA array
+def load_photo(name='test_image.jpg'):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images', name)
+    return np.asarray(Image.open(path).convert('RGBA'))
+
+# runs fn repeats times and returns the fastest time in seconds
+def best_time(fn, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_magic_wand(data, threshold=.95):
+    h, w = data.shape[:2]
+    seeds = {
+        'sky': (w//2, h//8),
+        'disc': (w//2, h//2),
+        'gradient': (w//8, h - h//8),
+    }
+    for name, (x, y) in seeds.items():
+        mask = flood_fill_mask(data, x, y, threshold)
+        seconds = best_time(lambda: flood_fill_mask(data, x, y, threshold))
+        print("magic_wand %-9s %5.1f MP  %8d px selected  %6.3f s" % (name, w*h/1e6, mask.sum(), seconds))
+
+# region index selections must match flood_fill_mask exactly, checked on small
+# random images of a few colors, including one pixel wide and one pixel high ones
+def check_selections(trials=200, seed=0):
+    rng = np.random.default_rng(seed)
+    for trial in range(trials):
+        h, w = rng.choice([1, 2, 7, 31], 2)
+        palette = rng.integers(0, 256, (rng.integers(1, 5), 4), dtype=np.uint8)
+        data = palette[rng.integers(0, len(palette), (h, w))]
+        data[..., :3] = np.clip(data[..., :3].astype(np.int16) + rng.integers(-20, 21, (h, w, 3)), 0, 255)
+        x, y = rng.integers(0, w), rng.integers(0, h)
+        regions = RegionIndex(data)
+        for threshold in (0, .5, .9, .95, rng.random()):
+            expected = flood_fill_mask(data, x, y, threshold)
+            assert (regions.select(x, y, threshold) == expected).all(), ("RegionIndex.select", w, h, x, y, threshold)
+    print("selections match flood fill on %d random images" % trials)
+
+# threshold tuning on the proxy on screen: every slider step is one flood fill of
+# the proxy, see Picture.preview_threshold
+def bench_threshold(data, name, bounds=(1920, 1080), steps=20):
+    image = Image.fromarray(data, 'RGBA')
+    proxy = np.asarray(Pyramid(image, bounds).select(fit_size(image.size, bounds)))
+    h, w = proxy.shape[:2]
+    thresholds = np.linspace(.5, .99, steps)
+
+    def slide():
+        for threshold in thresholds:
+            flood_fill_mask(proxy, w//2, h//8, threshold)
+
+    print("threshold %-9s %5.1f MP  %6.3f s per step" % (name, w*h/1e6, best_time(slide, 1) / steps))
+
+# magic wand selections answered from the region index, which is built once per
+# image, against flood filling every time; textured images get no index
+def bench_regions(data, name, threshold=.95):
+    h, w = data.shape[:2]
+    seeds = [(w//2, h//8), (w//2, h//2), (w//8, h - h//8)]
+    build = best_time(lambda: index_regions(data), 1)
+    regions = index_regions(data)
+    fill = best_time(lambda: [flood_fill_mask(data, x, y, threshold) for x, y in seeds]) / len(seeds)
+    if regions is None:
+        print("regions %-11s %5.1f MP  no index %6.3f s  flood fill %6.3f s" % (name, w*h/1e6, build, fill))
+        return
+    select = best_time(lambda: [regions.select(x, y, threshold) for x, y in seeds]) / len(seeds)
+    print("regions %-11s %5.1f MP  build %6.3f s  select %6.3f s  flood fill %6.3f s" % (name, w*h/1e6, build, select, fill))
+
+# the full round trip a transparency edit does: pil -> array -> edit -> pil
+def bench_masks(data, threshold=.95):
+    h, w = data.shape[:2]
+    image = Image.fromarray(data, 'RGBA')
+    mask = similar_color_mask(data, data[h//2, w//2], threshold)
+
+    def edit(fn):
+        edited = np.array(image)
+        fn(edited)
+        return Image.fromarray(edited, 'RGBA')
+
+    cases = {
+        'select': lambda: similar_color_mask(data, data[h//2, w//2], threshold),
+        'transparent': lambda: edit(lambda d: fill_mask(d, mask, (255, 255, 255, 0))),
+        'highlight': lambda: edit(lambda d: tint_mask(d, mask, (255, 0, 0, 255), .5)),
+        'grow+union': lambda: mask_union(grow_mask(mask, 2), mask),
+    }
+    for name, fn in cases.items():
+        print("masks %-14s %5.1f MP  %6.3f s" % (name, w*h/1e6, best_time(fn)))
+
+# block sizes the pixelate slider produces, plus a coarse one
+def bench_pixelate(data):
+    h, w = data.shape[:2]
+    for size in (2, 3, 16):
+        seconds = best_time(lambda: block_average(data, size, size))
+        print("pixelate %2dx%-2d       %5.1f MP  %6.3f s" % (size, size, w*h/1e6, seconds))
+
+# cpu side of a preview refresh: the old png round trip against the raw
+# bytes that are now handed to Texture.blit_buffer
+def bench_upload(data):
+    h, w = data.shape[:2]
+    image = Image.fromarray(data, 'RGBA')
+
+    def png_round_trip():
+        encoded = BytesIO()
+        image.save(encoded, format='png')
+        encoded.seek(0)
+        Image.open(encoded).load()
+
+    print("upload png          %5.1f MP  %6.3f s" % (w*h/1e6, best_time(png_round_trip, 1)))
+    print("upload raw bytes    %5.1f MP  %6.3f s" % (w*h/1e6, best_time(image.tobytes)))
+
+# bytes handed to the texture at the default zoom, full image against the pyramid
+# level, which is resized once per image and then reused on every upload
+def bench_pyramid(data, bounds=(1920, 1080)):
+    h, w = data.shape[:2]
+    image = Image.fromarray(data, 'RGBA')
+    level = Pyramid(image, bounds).level(0)
+    mb = lambda size: size[0]*size[1]*4/2**20
+
+    print("display full image  %5.1f MP  %6.3f s  %6.1f MB" % (w*h/1e6, best_time(image.tobytes), mb(image.size)))
+    print("display build level %5.1f MP  %6.3f s" % (w*h/1e6, best_time(lambda: Pyramid(image, bounds).level(0))))
+    print("display pyramid     %5.1f MP  %6.3f s  %6.1f MB" % (w*h/1e6, best_time(level.tobytes), mb(level.size)))
+
+# a stack of tonal edits applied one at a time against the fused edit log replay
+def bench_edit_log(data):
+    h, w = data.shape[:2]
+    image = Image.fromarray(data, 'RGBA')
+    ops = [('brightness', 1.2), ('contrast', 1.3), ('brightness', .9), ('contrast', .8)]
+
+    def one_at_a_time():
+        result = image
+        for op in ops:
+            if op[0] == 'brightness':
+                result = ImageEnhance.Brightness(result).enhance(op[1])
+            elif op[0] == 'contrast':
+                result = ImageEnhance.Contrast(result).enhance(op[1])
+        return result
+
+    print("edits one at a time %5.1f MP  %6.3f s" % (w*h/1e6, best_time(one_at_a_time)))
+    print("edits fused log     %5.1f MP  %6.3f s" % (w*h/1e6, best_time(lambda: render_ops(image, ops))))
+
+# web size and thumbnail exported one at a time from the full image against the
+# export cascade, where each size is resized from the one before and encoded in parallel
+def bench_export(data):
+    h, w = data.shape[:2]
+    image = Image.fromarray(data, 'RGBA')
+    targets = [('_web', (2048, 2048), 'jpeg web'), ('_small', (1024, 1024), 'jpeg'), ('_thumb', (320, 320), 'jpeg')]
+    directory = tempfile.mkdtemp(prefix='fotofix_bench_')
+    path = os.path.join(directory, 'photo.png')
+
+    def one_at_a_time():
+        for extra, bounds, preset in targets:
+            resized = image.resize(fit_size(image.size, bounds), Image.LANCZOS)
+            encode_image(resized, os.path.join(directory, 'photo' + extra + '.jpg'), preset)
+
+    print("export one at a time %4.1f MP  %6.3f s" % (w*h/1e6, best_time(one_at_a_time, 1)))
+    print("export cascade      %5.1f MP  %6.3f s" % (w*h/1e6, best_time(lambda: export_render(image, [], path, targets), 1)))
+    shutil.rmtree(directory)
+
+# banded operations with 1, 2, 4, ... threads up to the number of cores
+def bench_workers(data):
+    h, w = data.shape[:2]
+    image = Image.fromarray(data, 'RGBA')
+    color = ImageEnhance.Color(image)
+    cases = {
+        'lut': lambda: apply_point_ops(image, [('invert',), ('brightness', 1.2)]),
+        'saturation': lambda: enhance(color, 1.5),
+        'pixelate': lambda: pixelate_image(image, 1, image.size),
+        'select': lambda: similar_color_mask(data, data[h//2, w//2], .95),
+    }
+
+    cores = os.cpu_count() or 1
+    counts = sorted({1, cores} | {2**i for i in range(1, 6) if 2**i < cores})
+    for name, fn in cases.items():
+        base = None
+        for workers in counts:
+            set_workers(workers)
+            seconds = best_time(fn)
+            base = base or seconds
+            print("workers %-11s %2d threads %5.1f MP  %6.3f s  %4.1fx" % (name, workers, w*h/1e6, seconds, base/seconds))
+    set_workers(cores)
+
+if __name__ == "__main__":
+    check_selections()
+    data = make_test_image()
+    bench_magic_wand(data)
+    bench_masks(data)
+    textured = make_textured_image()
+    photo = load_photo()
+    bench_threshold(data, 'synthetic')
+    bench_threshold(textured, 'textured')
+    bench_threshold(photo, 'photo')
+    bench_regions(data, 'synthetic')
+    bench_regions(textured, 'textured')
+    bench_regions(photo, 'photo')
+    bench_pixelate(data)
+    bench_upload(data)
+    bench_pyramid(data)
+    bench_edit_log(data)
+    bench_export(data)
+    bench_workers(data)
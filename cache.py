@@ -0,0 +1,122 @@
+import os, threading
+from hashlib import blake2b
+
+from PIL import Image
+import numpy as np
+
+# bytes of decoded images kept on disk before the least recently opened are deleted
+DECODED_CACHE_BYTES = 2 * 2**30
+
+# where decoded images are kept, unless FOTOFIX_CACHE_DIR says otherwise
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.environ.get('FOTOFIX_CACHE_DIR') or os.path.join(base, 'fotofix', 'decoded')
+
+# on-disk cache of images decoded to RGBA, so reopening a big photo maps the pixels
+# straight from disk instead of decoding the file again
+# entries are raw .npy arrays keyed by the path, modification time and size of the
+# file they came from, so a file that changes is simply decoded again; images
+# opened from the cache share memory with the mapped file, which is fine since
+# images are never modified in place
+# the least recently opened entries are deleted once the cache takes up more than max_bytes
+class DecodedCache:
+    def __init__(self, directory=None, max_bytes=DECODED_CACHE_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # name of the entry for filepath as it is now, None if the file does not exist
+    def key(self, filepath):
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        name = '%s\0%d\0%d' % (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+        return blake2b(name.encode('utf-8'), digest_size=16).hexdigest() + '.npy'
+
+    # opens filepath as an RGBA image, from the cache when it has it
+    # new entries are written on a background thread so opening is never slowed down
+    def open(self, filepath):
+        key = self.key(filepath)
+        image = self.get(key) if key is not None else None
+        if image is not None:
+            self.hits += 1
+            return image
+
+        self.misses += 1
+        image = Image.open(filepath).convert("RGBA")
+        if key is not None:
+            threading.Thread(target=self.put, args=(key, image), name='fotofix-cache', daemon=True).start()
+        return image
+
+    # the cached image for key, or None
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            data = np.load(path, mmap_mode='r')
+            # opening counts as a use for the least recently used order
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if data.ndim != 3 or data.shape[2] != 4 or data.dtype != np.uint8:
+            return None
+        return Image.frombuffer('RGBA', (data.shape[1], data.shape[0]), data, 'raw', 'RGBA', 0, 1)
+
+    # writes image to the cache as key, the entry only shows up once it is complete
+    def put(self, key, image):
+        path = os.path.join(self.directory, key)
+        partial = path + '.%d.part' % threading.get_ident()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(partial, 'wb') as f:
+                np.save(f, np.asarray(image))
+            os.replace(partial, path)
+        except OSError as e:
+            print("could not cache %s: %s" % (key, e))
+            if os.path.exists(partial):
+                os.remove(partial)
+            return
+        self.enforce_budget()
+
+    # deletes the least recently opened entries until the cache fits in max_bytes
+    def enforce_budget(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.npy'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for __, size, __ in entries)
+            for __, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    # still mapped by an open image on some platforms, try again next time
+                    continue
+                total -= size
+
+    # bytes of entries on disk
+    def size(self):
+        if not os.path.isdir(self.directory):
+            return 0
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory) if name.endswith('.npy'))
+
+    # deletes every entry
+    def clear(self):
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                return
+            for name in os.listdir(self.directory):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
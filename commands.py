@@ -35,6 +35,10 @@ commands = {
 
     'save': 'save',
 
+    # applies the edits to the other photos in the gallery
+    'replay': 'replay',
+    'batch': 'replay',
+
     'saturation': 'saturation',
     'saturate': 'saturation',
 
@@ -93,6 +97,14 @@ stickers = {
 transparent_commands = {
     'apply' : 'apply',
     'here' : 'apply',
+
+    'preview' : 'preview',
+    'select' : 'preview',
+
+    'up': 'up',
+    'increase': 'up',
+    'down': 'down',
+    'decrease': 'down',
 }
 
 zoom_commands = {
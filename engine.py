@@ -0,0 +1,1299 @@
+import os, time, math, json, base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageEnhance
+import numpy as np
+
+from history import History
+from jobs import JobCancelled, check_cancelled
+
+# the pixel side of fotofix: image operations, the edit log and a headless
+# editing session, using only PIL and numpy so batch jobs, benchmarks and
+# scripts can import it without kivy or a window; picture.py draws a Session
+
+# banded execution
+# big images are split into horizontal bands of rows that are processed on a
+# pool of threads; PIL and numpy release the GIL while they work on pixels, so
+# the bands run in parallel and each one is written straight into its rows of
+# the output
+
+# number of threads used for banded operations, see set_workers
+WORKERS = os.cpu_count() or 1
+
+# bands are never smaller than this, small images are not worth splitting
+MIN_BAND_ROWS = 64
+
+executors = {}
+
+def set_workers(workers):
+    global WORKERS
+    WORKERS = max(int(workers), 1)
+
+def get_executor(workers):
+    if workers not in executors:
+        executors[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fotofix')
+    return executors[workers]
+
+# exports encode on a pool of their own, so long encodes never hold up the bands
+# of previews and edits queued on the executor of get_executor
+encoders = {}
+
+def get_encoder(workers):
+    if workers not in encoders:
+        encoders[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fotofix-encode')
+    return encoders[workers]
+
+# splits height rows into up to workers bands of (top, bottom)
+# every band but the last starts on a multiple of align rows
+def row_bands(height, workers, align=1):
+    count = max(min(workers, height // MIN_BAND_ROWS), 1)
+    size = -(-height // count)
+    size = -(-size // align) * align
+    return [(top, min(top + size, height)) for top in range(0, height, size)]
+
+# calls fn(top, bottom) for every band, on the thread pool when there is more than one
+def run_bands(fn, height, workers=None, align=1):
+    workers = WORKERS if workers is None else workers
+    bands = row_bands(height, workers, align)
+    if len(bands) == 1:
+        fn(0, height)
+        return
+
+    # stop waiting for the remaining bands if the job running this gets cancelled
+    futures = [get_executor(workers).submit(fn, top, bottom) for top, bottom in bands]
+    try:
+        for future in futures:
+            future.result()
+            check_cancelled()
+    except JobCancelled:
+        for future in futures:
+            future.cancel()
+        raise
+
+# runs fn on matching bands of same sized images and pastes the resulting bands
+# into a single new image, fn must keep the size and mode of its input
+def map_bands(fn, images, workers=None, align=1):
+    width, height = images[0].size
+    result = Image.new(images[0].mode, images[0].size)
+
+    def band(top, bottom):
+        crops = [image.crop((0, top, width, bottom)) for image in images]
+        result.paste(fn(*crops), (0, top))
+
+    run_bands(band, height, workers, align)
+    return result
+
+# helper functions
+# squared rgb distance between every pixel of an (h, w, 4) array and color
+def color_distance_squared(data, color):
+    distance = np.zeros(data.shape[:2], dtype=np.int32)
+    for c in range(3):
+        delta = data[..., c].astype(np.int32) - int(color[c])
+        distance += delta * delta
+    return distance
+
+# largest squared color distance a threshold still counts as similar
+# threshold = 1: only the exact color, threshold = 0: every color
+def threshold_distance(threshold):
+    assert(threshold >= 0 and threshold <= 1)
+    max_delta = (((255**2) * 3)**.5) * (1 - threshold)
+    return max_delta**2
+
+# boolean (h, w) mask of the pixels whose color is within threshold of color
+def similar_color_mask(data, color, threshold = .5):
+    max_distance = threshold_distance(threshold)
+    mask = np.empty(data.shape[:2], dtype=bool)
+
+    def band(top, bottom):
+        mask[top:bottom] = color_distance_squared(data[top:bottom], color) <= max_distance
+
+    run_bands(band, data.shape[0])
+    return mask
+
+# finds every horizontal run of True pixels in a boolean mask
+# returns the row, start (inclusive) and end (exclusive) of each run
+def mask_runs(mask):
+    h, w = mask.shape
+    padded = np.zeros((h, w + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+
+    rows, starts = np.nonzero(edges == 1)
+    __, ends = np.nonzero(edges == -1)
+    return rows, starts, ends
+
+# pairs (a, b) of runs where run b is in the row below run a and they touch
+def run_adjacency(rows, starts, ends, width):
+    # runs are sorted by row then column, so flattened keys are sorted too
+    stride = width + 1
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    below = (rows + 1) * stride
+
+    # runs in the next row that end after a starts and start before a ends
+    first = np.searchsorted(end_keys, below + starts, side='right')
+    last = np.searchsorted(start_keys, below + ends, side='left')
+    counts = np.maximum(last - first, 0)
+
+    a = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    b = np.repeat(first, counts) + offsets
+    return a, b
+
+# labels n runs by connected component given their adjacency pairs
+# every run in a component ends up labelled with its smallest run index
+def label_runs(n, a, b):
+    labels = np.arange(n)
+    while True:
+        la, lb = labels[a], labels[b]
+        differ = la != lb
+        if not differ.any():
+            return labels
+
+        check_cancelled()
+
+        # hook the larger root onto the smaller one, then flatten the trees
+        a, b, la, lb = a[differ], b[differ], la[differ], lb[differ]
+        np.minimum.at(labels, np.maximum(la, lb), np.minimum(la, lb))
+        while True:
+            parent = labels[labels]
+            if np.array_equal(parent, labels):
+                break
+            labels = parent
+
+# paints runs back into an (h, w) boolean mask
+def runs_to_mask(rows, starts, ends, shape):
+    h, w = shape
+    # a run may end where the next one starts, then the two edges cancel out
+    edges = np.zeros(h * (w + 1), dtype=np.int8)
+    edges[rows * (w + 1) + starts] += 1
+    edges[rows * (w + 1) + ends] -= 1
+    return np.cumsum(edges, dtype=np.int8).reshape(h, w + 1)[:, :w].astype(bool)
+
+# mask operations
+# masks are (h, w) boolean arrays lined up with an (h, w, 4) rgba array
+
+# accepts a boolean array or an old style flat list of 0s and 1s
+def as_mask(mask, shape):
+    return np.asarray(mask, dtype=bool).reshape(shape[:2])
+
+def mask_union(a, b):
+    return np.logical_or(a, b)
+
+def mask_intersect(a, b):
+    return np.logical_and(a, b)
+
+def mask_invert(mask):
+    return np.logical_not(mask)
+
+# grows the selection by pixels in the four directions
+def grow_mask(mask, pixels=1):
+    mask = mask.copy()
+    for _ in range(pixels):
+        grown = mask.copy()
+        grown[1:, :] |= mask[:-1, :]
+        grown[:-1, :] |= mask[1:, :]
+        grown[:, 1:] |= mask[:, :-1]
+        grown[:, :-1] |= mask[:, 1:]
+        mask = grown
+    return mask
+
+# shrinks the selection by pixels in the four directions
+def shrink_mask(mask, pixels=1):
+    mask = mask.copy()
+    for _ in range(pixels):
+        shrunk = mask.copy()
+        shrunk[1:, :] &= mask[:-1, :]
+        shrunk[:-1, :] &= mask[1:, :]
+        shrunk[:, 1:] &= mask[:, :-1]
+        shrunk[:, :-1] &= mask[:, 1:]
+        mask = shrunk
+    return mask
+
+# sets every masked pixel of an (h, w, 4) array to color, in place
+def fill_mask(data, mask, color):
+    if data.flags.c_contiguous:
+        # write whole rgba pixels at once through a 32 bit view
+        pixels = data.view(np.uint32).reshape(mask.shape)
+        pixels[mask] = np.array(color, dtype=np.uint8).view(np.uint32)[0]
+    else:
+        data[mask] = color
+    return data
+
+# blends every masked pixel of an (h, w, 4) array towards color, in place
+# strength = 1: pixels become color, strength = 0: pixels are unchanged
+def tint_mask(data, mask, color, strength=1.0):
+    if strength >= 1:
+        return fill_mask(data, mask, color)
+    selected = data[mask].astype(np.float32)
+    selected += (np.asarray(color, dtype=np.float32) - selected) * strength
+    data[mask] = np.round(selected).astype(np.uint8)
+    return data
+
+# selects the 4-connected region of pixels similar in color to (x, y)
+# data is an (h, w, 4) array, returns an (h, w) boolean mask
+def flood_fill_mask(data, x, y, threshold = .5):
+    return seed_component(similar_color_mask(data, data[y, x], threshold), x, y)
+
+# the pixels of mask connected to (x, y), which must be in mask
+def seed_component(mask, x, y):
+    h, w = mask.shape
+    rows, starts, ends = mask_runs(mask)
+
+    # the run holding the seed pixel (always selected, its distance is 0)
+    seed = np.searchsorted(rows * (w + 1) + starts, y * (w + 1) + x, side='right') - 1
+
+    a, b = run_adjacency(rows, starts, ends, w)
+    labels = label_runs(len(rows), a, b)
+    keep = labels == labels[seed]
+    return runs_to_mask(rows[keep], starts[keep], ends[keep], (h, w))
+
+# bits kept per color channel when grouping pixels into regions
+REGION_BITS = 2
+
+# runs of one bin per pixel above which an image gets no region index: the regions
+# of textured photos are tiny, so the index takes long to build and selecting
+# through it is slower than flood_fill_mask
+REGION_MAX_RUNS = 1/16
+
+# the bin of every pixel, keeping bits bits per channel
+def region_keys(data, bits=REGION_BITS):
+    shift = 8 - bits
+    key = (data[..., 0].astype(np.int32) >> shift) << 2*bits
+    key |= (data[..., 1].astype(np.int32) >> shift) << bits
+    key |= data[..., 2].astype(np.int32) >> shift
+    return key
+
+# the RegionIndex of data, or None when its regions are too small for one to pay
+# off, which is estimated from every 8th row
+def index_regions(data, bits=REGION_BITS, max_runs=REGION_MAX_RUNS):
+    key = region_keys(data[::8], bits)
+    runs = key.shape[0] + np.count_nonzero(key[:, 1:] != key[:, :-1])
+    if runs > max_runs * key.size:
+        return None
+    return RegionIndex(data, bits)
+
+# index of the flat colored regions of an image for fast magic wand selections
+# a region is a connected group of pixels whose colors land in the same bin when
+# keeping REGION_BITS bits per channel; the index keeps the runs of every region,
+# its color range and bounding box, and which regions touch
+class RegionIndex:
+    def __init__(self, data, bits=REGION_BITS):
+        h, w = data.shape[:2]
+        self.data = data
+        self.shape = (h, w)
+
+        key = region_keys(data, bits)
+
+        # split every row into runs of the same key
+        change = np.ones((h, w), dtype=bool)
+        change[:, 1:] = key[:, 1:] != key[:, :-1]
+        rows, starts = np.nonzero(change)
+        same_row = np.append(rows[1:] == rows[:-1], False)
+        ends = np.where(same_row, np.append(starts[1:], 0), w)
+        run_keys = key[rows, starts]
+        check_cancelled()
+
+        # runs with the same key that touch make up a region
+        a, b = run_adjacency(rows, starts, ends, w)
+        same = run_keys[a] == run_keys[b]
+        labels = label_runs(len(rows), a[same], b[same])
+        __, region = np.unique(labels, return_inverse=True)
+        n = region.max() + 1
+        self.rows, self.starts, self.ends, self.region = rows, starts, ends, region
+
+        # color range of every region, runs are contiguous in the flattened image
+        colors = data[..., :3].reshape(-1, 3)
+        flat_starts = rows * w + starts
+        self.low = np.full((n, 3), 255, dtype=np.int32)
+        self.high = np.zeros((n, 3), dtype=np.int32)
+        np.minimum.at(self.low, region, np.minimum.reduceat(colors, flat_starts, axis=0))
+        np.maximum.at(self.high, region, np.maximum.reduceat(colors, flat_starts, axis=0))
+        check_cancelled()
+
+        # bounding boxes as (left, top, right, bottom)
+        self.boxes = np.empty((n, 4), dtype=np.int64)
+        self.boxes[:, :2] = [w, h]
+        self.boxes[:, 2:] = 0
+        np.minimum.at(self.boxes[:, 0], region, starts)
+        np.minimum.at(self.boxes[:, 1], region, rows)
+        np.maximum.at(self.boxes[:, 2], region, ends)
+        np.maximum.at(self.boxes[:, 3], region, rows + 1)
+
+        # regions touching each other vertically or side by side
+        a = np.concatenate([region[a], region[:-1][same_row[:-1]]])
+        b = np.concatenate([region[b], region[1:][same_row[:-1]]])
+        edges = np.unique(np.minimum(a, b) * n + np.maximum(a, b))
+        edges = edges[edges // n != edges % n]
+        self.edge_a, self.edge_b = edges // n, edges % n
+
+    # same result as flood_fill_mask(data, x, y, threshold) on the indexed image
+    # regions are first ruled in or out by their color range, and if every region
+    # the seed reaches is within threshold as a whole, the selection is just those
+    # regions; otherwise the flood fill only runs on the box around the reached regions
+    def select(self, x, y, threshold = .5):
+        h, w = self.shape
+        color = self.data[y, x, :3].astype(np.int32)
+        max_distance = threshold_distance(threshold)
+
+        # squared distance from color to the nearest and farthest color of each region
+        low, high = self.low - color, self.high - color
+        nearest = np.where(low > 0, low, np.where(high < 0, high, 0))
+        near = (nearest * nearest).sum(axis=1)
+        far = np.maximum(low * low, high * high).sum(axis=1)
+
+        # regions that may hold selected pixels and connect to the seed through such regions
+        run = np.searchsorted(self.rows * (w + 1) + self.starts, y * (w + 1) + x, side='right') - 1
+        seed = self.region[run]
+        candidate = near <= max_distance
+        keep = candidate[self.edge_a] & candidate[self.edge_b]
+        labels = label_runs(len(near), self.edge_a[keep], self.edge_b[keep])
+        reached = labels == labels[seed]
+
+        runs = reached[self.region]
+        if (far[reached] <= max_distance).all():
+            return runs_to_mask(self.rows[runs], self.starts[runs], self.ends[runs], self.shape)
+
+        # edge refinement, limited to the pixels of the reached regions
+        boxes = self.boxes[reached]
+        left, top = boxes[:, 0].min(), boxes[:, 1].min()
+        right, bottom = boxes[:, 2].max(), boxes[:, 3].max()
+        allowed = runs_to_mask(self.rows[runs] - top, self.starts[runs] - left, self.ends[runs] - left, (bottom - top, right - left))
+        crop = self.data[top:bottom, left:right]
+        selected = similar_color_mask(crop, color, threshold) & allowed
+
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[top:bottom, left:right] = seed_component(selected, x - left, y - top)
+        return mask
+
+# largest size with the aspect ratio of size that fits inside bounds
+# images are only ever scaled down, never up
+def fit_size(size, bounds):
+    scale = min(bounds[0]/size[0], bounds[1]/size[1], 1)
+    return max(int(size[0]*scale), 1), max(int(size[1]*scale), 1)
+
+# downscaled copies of image for display and live previews, like a mipmap
+# level 0 fits bounds and every next level is twice as big, up to the image itself
+# levels are only resized the first time they are needed, from the next bigger
+# level that already exists rather than from the original
+class Pyramid:
+    def __init__(self, image, bounds):
+        self.image = image
+        self.bounds = bounds
+        self.sizes = []
+        self.levels = {}
+
+        # (level, old level, box) for levels copied from the pyramid of an image
+        # that only differed inside box, see patch; the image itself counts as a level
+        self.patches = []
+
+        scale = 1
+        size = fit_size(image.size, bounds)
+        while size[0] < image.size[0] and size[1] < image.size[1]:
+            self.sizes.append(size)
+            scale *= 2
+            size = fit_size(image.size, (bounds[0]*scale, bounds[1]*scale))
+
+    # returns the smallest level that covers size on screen
+    # falls back to the full resolution image when zoomed in past every level
+    def select(self, size):
+        for i, level_size in enumerate(self.sizes):
+            if level_size[0] >= size[0] and level_size[1] >= size[1]:
+                return self.level(i)
+        return self.image
+
+    def level(self, i):
+        level = self.levels.get(i)
+        if level is None:
+            source = self.image
+            for j in range(i + 1, len(self.sizes)):
+                if j in self.levels:
+                    source = self.levels[j]
+                    break
+            level = source.resize(self.sizes[i], Image.BILINEAR, reducing_gap=2.0)
+            self.levels[i] = level
+        return level
+
+    # returns the pyramid of image, which is the image of this pyramid changed only inside box
+    # levels computed here are copied over with only the box resized again
+    def patch(self, image, box):
+        pyramid = Pyramid(image, self.bounds)
+        if pyramid.sizes != self.sizes:
+            return pyramid
+        pyramid.patches.append((image, self.image, box))
+
+        for i, level in self.levels.items():
+            scale_x, scale_y = level.size[0] / image.size[0], level.size[1] / image.size[1]
+            # one extra pixel around the box for the footprint of the filter
+            level_box = (max(int(box[0]*scale_x) - 1, 0), max(int(box[1]*scale_y) - 1, 0),
+                         min(math.ceil(box[2]*scale_x) + 1, level.size[0]), min(math.ceil(box[3]*scale_y) + 1, level.size[1]))
+            region = image.resize((level_box[2] - level_box[0], level_box[3] - level_box[1]), Image.BILINEAR,
+                                  box=(level_box[0]/scale_x, level_box[1]/scale_y, level_box[2]/scale_x, level_box[3]/scale_y))
+            copy = level.copy()
+            copy.paste(region, level_box[:2])
+            pyramid.levels[i] = copy
+            pyramid.patches.append((copy, level, level_box))
+        return pyramid
+
+    # returns (old level, box) if level was patched from old level, otherwise None
+    def changes(self, level):
+        for patched, old, box in self.patches:
+            if patched is level:
+                return old, box
+        return None
+
+# box around the True pixels of mask, (0, 0, 0, 0) if there are none
+def mask_box(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return (0, 0, 0, 0)
+    cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+# smallest box holding boxes a and b, empty boxes are ignored
+def union_box(a, b):
+    if a[0] >= a[2] or a[1] >= a[3]:
+        return b
+    if b[0] >= b[2] or b[1] >= b[3]:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+# overlap of boxes a and b, None if they do not overlap
+def intersect_box(a, b):
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return None
+    return box
+
+# sums every size-long run of an array along axis, the last run may be shorter
+# returns the sums and the number of elements that went into each one
+def sum_blocks(data, size, axis, dtype):
+    n = data.shape[axis]
+    along = lambda s: (slice(None),)*axis + (s,)
+
+    # add up strided slices rather than reshaping, so no padded copy is needed
+    sums = data[along(slice(0, n, size))].astype(dtype)
+    counts = np.ones(sums.shape[axis], dtype=dtype)
+    for i in range(1, size):
+        part = data[along(slice(i, n, size))]
+        sums[along(slice(0, part.shape[axis]))] += part
+        counts[:part.shape[axis]] += 1
+    return sums, counts
+
+# sets every square_h x square_w block of an (h, w, 4) array to its average
+# color, keeping the alpha of each pixel; blocks on the right and bottom edges
+# may be smaller and are averaged over the pixels they actually contain
+def block_average(data, square_h, square_w):
+    h, w = data.shape[:2]
+    if square_h == 1 and square_w == 1:
+        return np.array(data)
+
+    # small blocks fit their sums in 16 bits, which halves the memory traffic
+    dtype = np.uint16 if square_h * square_w * 255 < 2**16 else np.uint32
+    sums, row_counts = sum_blocks(data, square_h, 0, dtype)
+    sums, col_counts = sum_blocks(sums, square_w, 1, dtype)
+    counts = np.outer(row_counts, col_counts).astype(dtype)
+    means = (sums // counts[..., None]).astype(np.uint8)
+
+    # broadcast the block averages back over the pixels of each block
+    result = np.repeat(np.repeat(means, square_h, axis=0)[:h], square_w, axis=1)[:, :w]
+    result[..., 3] = data[..., 3]
+    return result
+
+# pixelates image for a slider factor between 0 and 1
+# full_size is the size of the full resolution image the factor was picked for,
+# so the squares stay the same relative size when image is a downscaled proxy
+def pixelate_image(image, factor, full_size):
+    if factor == 0:
+        return image
+
+    width, height = full_size
+
+    # scale factor between 0.3 and 0.7
+    factor = factor * (0.7 - 0.3) + 0.3
+
+    # math to work out the pixelation factor, feel free to make this prettier
+    num_cols = int(max(round((1 - factor) * width), 1))
+    square_w = max(round(width / num_cols), 1)
+    num_rows = int(max(round((1 - factor) * height), 1))
+    square_h = max(round(height / num_rows), 1)
+
+    # squares are measured on the full image, so scale them down for proxies
+    scale = image.size[0] / width
+    square_w = max(round(square_w * scale), 1)
+    square_h = max(round(square_h * scale), 1)
+
+    # overwrite each square with the average color, bands line up with the squares
+    average = lambda band: Image.fromarray(block_average(np.asarray(band), square_h, square_w), 'RGBA')
+    return map_bands(average, [image], align=square_h)
+
+# edit log
+# every committed edit is recorded as an op, a tuple of its name and parameters
+# positions are stored relative to the image size so the log can be replayed on
+# the original image at full resolution or on a downscaled proxy of it:
+#   ('brightness', factor), ('contrast', factor), ('saturation', factor),
+#   ('sharpness', factor), ('pixelate', factor, full_size), ('invert',),
+#   ('grayscale',), ('crop', box), ('rotate', angle, expand),
+#   ('sticker', filepath, x, y, full_width), ('transparent', packed_mask, shape)
+
+# point ops only map each pixel to a new value on its own, so runs of them are
+# fused into a single lookup table and applied (and rounded) once
+# grayscale mixes the color channels, so tables before and after it are
+# applied separately, but still without leaving the run
+POINT_OPS = {'brightness', 'contrast', 'invert', 'grayscale'}
+
+# float lookup tables (3 x 256) for a run of point ops applied to image
+# contrast blends towards the mean gray of its input, which is worked out
+# from the histograms of image pushed through the tables so far
+# ops may not contain grayscale, see apply_point_ops
+# histogram can be passed in when the histogram of image is already known
+def point_ops_lut(image, ops, histogram=None):
+    lut = np.tile(np.arange(256, dtype=np.float64), (3, 1))
+    for op in ops:
+        if op[0] == 'brightness':
+            lut = lut * op[1]
+        elif op[0] == 'invert':
+            lut = 255 - lut
+        elif op[0] == 'contrast':
+            if histogram is None:
+                histogram = image.histogram()
+            histogram = np.array(histogram[:768], dtype=np.float64).reshape(3, 256)
+            means = (histogram * lut).sum(axis=1) / max(histogram[0].sum(), 1)
+            mean = int(np.dot((.299, .587, .114), means) + .5)
+            lut = mean + (lut - mean) * op[1]
+        lut = np.clip(lut, 0, 255)
+    return lut
+
+# applies 3 x 256 tables to the color channels of an RGBA image, keeping alpha
+def apply_lut(image, lut):
+    table = np.concatenate((np.round(lut).astype(np.uint8).ravel(), np.arange(256, dtype=np.uint8)))
+    table = table.tolist()
+    return map_bands(lambda band: band.point(table), [image])
+
+# ImageEnhance.enhance, blending the enhancer's degenerate image band by band
+def enhance(enhancer, factor):
+    return map_bands(lambda degenerate, image: Image.blend(degenerate, image, factor), [enhancer.degenerate, enhancer.image])
+
+# converts the color channels of an RGBA image to gray, keeping alpha
+def gray_rgba(image):
+    gray = image.convert('L')
+    return Image.merge('RGBA', (gray, gray, gray, image.getchannel('A')))
+
+# applies a run of point ops to an RGBA image with one table lookup per
+# grayscale-separated stretch, so a stack of tonal edits costs about as much as one
+# histogram is the (optional, precomputed) histogram of image
+def apply_point_ops(image, ops, histogram=None):
+    run = []
+    for op in ops:
+        if op[0] == 'grayscale':
+            if run:
+                image = apply_lut(image, point_ops_lut(image, run, histogram))
+            image = gray_rgba(image)
+            run = []
+            histogram = None
+        else:
+            run.append(op)
+    if run:
+        image = apply_lut(image, point_ops_lut(image, run, histogram))
+    return image
+
+# quarter turns map straight onto transposes, which move pixels without resampling
+TRANSPOSES = {90: Image.ROTATE_90, 180: Image.ROTATE_180, 270: Image.ROTATE_270}
+
+# rotates image counterclockwise by angle degrees, like Image.rotate
+def rotate_image(image, angle, expand=True):
+    angle %= 360
+    if angle == 0:
+        return image
+    if angle in TRANSPOSES and (expand or angle == 180):
+        return image.transpose(TRANSPOSES[angle])
+    return image.rotate(angle, expand=expand)
+
+# applies a single op that is not a point op
+def apply_op(image, op):
+    name = op[0]
+    if name == 'saturation':
+        return enhance(ImageEnhance.Color(image), op[1])
+    if name == 'sharpness':
+        return enhance(ImageEnhance.Sharpness(image), op[1])
+    if name == 'pixelate':
+        return pixelate_image(image, op[1], op[2] or image.size)
+    if name == 'crop':
+        width, height = image.size
+        left, top, right, bottom = op[1]
+        return image.crop((left*width, top*height, right*width, bottom*height))
+    if name == 'rotate':
+        return rotate_image(image, op[1], op[2])
+    if name == 'sticker':
+        filepath, x, y, full_width = op[1:]
+        sticker = Image.open(filepath).convert("RGBA")
+        scale = image.size[0] / full_width if full_width else 1
+        if scale != 1:
+            size = (max(round(sticker.size[0]*scale), 1), max(round(sticker.size[1]*scale), 1))
+            sticker = sticker.resize(size, Image.BILINEAR)
+        location = (int(round(x*image.size[0])) - sticker.size[0]//2, int(round(y*image.size[1])) - sticker.size[1]//2)
+        result = image.copy()
+        result.paste(sticker, location, sticker)
+        return result
+    if name == 'transparent':
+        packed, shape = op[1:]
+        mask = np.unpackbits(packed, count=shape[0]*shape[1]).reshape(shape).astype(bool)
+        if mask.shape != (image.size[1], image.size[0]):
+            mask = np.asarray(Image.fromarray(mask).resize(image.size, Image.NEAREST))
+        data = np.array(image)
+        fill_mask(data, mask, (255, 255, 255, 0))
+        return Image.fromarray(data, 'RGBA')
+    raise ValueError("unknown edit op: %s" % name)
+
+# replays ops on image, fusing each run of point ops into one pass
+def render_ops(image, ops):
+    i = 0
+    while i < len(ops):
+        if ops[i][0] in POINT_OPS:
+            j = i
+            while j < len(ops) and ops[j][0] in POINT_OPS:
+                j += 1
+            image = apply_point_ops(image, ops[i:j])
+            i = j
+        else:
+            image = apply_op(image, ops[i])
+            i += 1
+    return image
+
+# edit recipes
+# a recipe is an edit log saved as json, with every op written as a list, so the
+# same edits can be replayed on other images, for example:
+#   [["crop", [0.1, 0.1, 0.9, 0.9]], ["rotate", 90], ["brightness", 1.2],
+#    ["grayscale"], ["sticker", "stickers/heart.png", 0.5, 0.75]]
+# trailing parameters that depend on the image an edit was made on can be left out:
+# ["pixelate", factor] pixelates relative to the image it is applied to,
+# ["rotate", angle] expands the image and ["sticker", filepath, x, y] pastes the
+# sticker at its own size; sticker paths are relative to the working directory
+# transparent masks are stored as base64 packed bits and stretched to fit
+
+# kinds of the parameters of every op, and the defaults of the ones that can be left out
+RECIPE_OPS = {
+    'brightness': (('factor',), ()), 'contrast': (('factor',), ()),
+    'saturation': (('factor',), ()), 'sharpness': (('factor',), ()),
+    'pixelate': (('fraction', 'size'), (None,)), 'invert': ((), ()), 'grayscale': ((), ()),
+    'crop': (('box',), ()), 'rotate': (('number', 'flag'), (True,)),
+    'sticker': (('path', 'number', 'number', 'width'), (None,)),
+    'transparent': (('bits', 'shape'), ()),
+}
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def is_size(value):
+    return isinstance(value, list) and len(value) == 2 and all(isinstance(v, int) and not isinstance(v, bool) and v > 0 for v in value)
+
+# true when value is a valid recipe parameter of kind, see RECIPE_OPS
+def recipe_param_ok(kind, value):
+    if kind == 'factor':
+        return is_number(value) and value >= 0
+    if kind == 'fraction':
+        return is_number(value) and 0 <= value <= 1
+    if kind == 'number':
+        return is_number(value)
+    if kind == 'flag':
+        return isinstance(value, bool)
+    if kind == 'size':
+        return value is None or is_size(value)
+    if kind == 'shape':
+        return is_size(value)
+    if kind == 'width':
+        return value is None or is_number(value) and value > 0
+    if kind == 'box':
+        # (left, top, right, bottom) as fractions of the image
+        return (isinstance(value, list) and len(value) == 4 and all(is_number(v) for v in value)
+                and 0 <= value[0] < value[2] <= 1 and 0 <= value[1] < value[3] <= 1)
+    if kind == 'path':
+        return isinstance(value, str) and os.path.isfile(value)
+    if kind == 'bits':
+        return isinstance(value, str)
+    return False
+
+# turns the ops of a recipe into edit log ops, raises ValueError on a bad recipe,
+# so a batch fails before any image is opened rather than on every one of them
+def recipe_ops(recipe):
+    if not isinstance(recipe, list):
+        raise ValueError("a recipe is a list of edit ops")
+    ops = []
+    for step in recipe:
+        if not isinstance(step, list) or not step or not isinstance(step[0], str) or step[0] not in RECIPE_OPS:
+            raise ValueError("unknown edit op: %r" % (step,))
+        name, params = step[0], step[1:]
+        kinds, defaults = RECIPE_OPS[name]
+        count = len(kinds)
+        if not count - len(defaults) <= len(params) <= count:
+            raise ValueError("wrong number of parameters for %s: %r" % (name, step))
+        params = params + list(defaults[len(defaults) - (count - len(params)):])
+        for kind, param in zip(kinds, params):
+            if not recipe_param_ok(kind, param):
+                raise ValueError("bad %s parameter for %s: %r" % (kind, name, step))
+        if name == 'crop' or name == 'pixelate' and params[1] is not None:
+            params[-1] = tuple(params[-1])
+        if name == 'transparent':
+            try:
+                packed = np.frombuffer(base64.b64decode(params[0], validate=True), dtype=np.uint8)
+            except ValueError:
+                raise ValueError("bad mask for transparent: not base64")
+            if len(packed) * 8 < params[1][0] * params[1][1]:
+                raise ValueError("bad mask for transparent: %d bytes for a %d x %d mask" % (len(packed), params[1][1], params[1][0]))
+            params = [packed, tuple(params[1])]
+        ops.append((name,) + tuple(params))
+    return ops
+
+# turns edit log ops into a recipe that can be written as json
+def ops_recipe(ops):
+    recipe = []
+    for op in ops:
+        step = [op[0]] + list(op[1:])
+        if op[0] == 'transparent':
+            step = [op[0], base64.b64encode(op[1].tobytes()).decode('ascii'), list(op[2])]
+        recipe.append([list(param) if isinstance(param, tuple) else param for param in step])
+    return recipe
+
+def load_recipe(path):
+    with open(path) as f:
+        return recipe_ops(json.load(f))
+
+def save_recipe(ops, path):
+    with open(path, 'w') as f:
+        json.dump(ops_recipe(ops), f)
+
+def quantize(value, step):
+    return round(round(value / step) * step, 6)
+
+# number of bytes of pixel data in a PIL image
+def image_bytes(image):
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+# least recently used cache that evicts old entries once the values it holds
+# take up more than max_bytes, as measured by size_of
+class LRUCache:
+    def __init__(self, max_bytes, size_of=image_bytes):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    # returns the cached value for key, or default if there is none
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.pop(key)
+        size = self.size_of(value)
+        self.entries[key] = (value, size)
+        self.bytes += size
+
+        # evict least recently used entries, but always keep the newest one
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            __, (__, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+
+    def pop(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value, size = self.entries.pop(key)
+        self.bytes -= size
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+# saving
+# presets are name -> (PIL format, file extension, save options)
+# jpeg has no alpha channel, so transparent pixels are flattened onto white
+# webp keeps alpha, losslessly with 'webp lossless'
+SAVE_PRESETS = OrderedDict([
+    ('png', ('PNG', '.png', {'compress_level': 6})),
+    ('png fast', ('PNG', '.png', {'compress_level': 1})),
+    ('png small', ('PNG', '.png', {'compress_level': 9})),
+    ('jpeg high', ('JPEG', '.jpg', {'quality': 95, 'subsampling': 0})),
+    ('jpeg', ('JPEG', '.jpg', {'quality': 85})),
+    ('jpeg web', ('JPEG', '.jpg', {'quality': 70, 'optimize': True, 'progressive': True})),
+    ('webp', ('WEBP', '.webp', {'quality': 85, 'method': 4})),
+    ('webp web', ('WEBP', '.webp', {'quality': 70, 'method': 4})),
+    ('webp lossless', ('WEBP', '.webp', {'lossless': True, 'method': 4})),
+])
+
+# where an edited copy of filepath is saved: name_fotofix<extra>.<extension of preset>
+# next to filepath, or in directory
+def save_path(filepath, extra="", preset='png', directory=None):
+    base = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(directory or os.path.dirname(filepath), base + "_fotofix" + extra + SAVE_PRESETS[preset][1])
+
+# RGB copy of an RGBA image over a plain background
+def flatten(image, color=(255, 255, 255)):
+    if image.mode != 'RGBA' or image.getchannel('A').getextrema()[0] == 255:
+        return image.convert('RGB')
+    background = Image.new('RGB', image.size, color)
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+# encodes image to path with a save preset, the file only shows up once it is complete
+# returns (path, bytes written, encode seconds)
+def encode_image(image, path, preset='png'):
+    format, extension, options = SAVE_PRESETS[preset]
+    start = time.perf_counter()
+    if format == 'JPEG':
+        image = flatten(image)
+    partial = path + '.part'
+    try:
+        image.save(partial, format=format, **options)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return path, os.path.getsize(path), time.perf_counter() - start
+
+# replays ops on original and encodes the result to path
+# images are never modified in place and the edit log is only ever replaced, so
+# original and ops are a snapshot that can be handed to another thread as they are
+# returns (path, bytes written, render seconds, encode seconds)
+def save_render(original, ops, path, preset='png'):
+    start = time.perf_counter()
+    image = render_ops(original, ops)
+    render_time = time.perf_counter() - start
+    path, size, encode_time = encode_image(image, path, preset)
+    return path, size, render_time, encode_time
+
+# sizes an edited image is exported at, as (extra, bounds, preset): the file goes
+# to save_path(filepath, extra, preset) and is scaled down to fit bounds, or kept
+# at full size when bounds is None
+EXPORT_SIZES = [
+    ('', None, 'png'),
+    ('_web', (2048, 2048), 'jpeg web'),
+    ('_thumb', (320, 320), 'jpeg'),
+]
+
+# replays ops on original once and saves the result at every size in targets
+# sizes are made biggest first, each one resized from the one before instead of
+# from the full image, and encoded on the thread pool while the next one is resized
+# returns (files, render seconds, total seconds), where files has the
+# (path, size, bytes written, resize seconds, encode seconds) of every target
+def export_render(original, ops, filepath, targets=EXPORT_SIZES, directory=None):
+    start = time.perf_counter()
+    image = render_ops(original, ops)
+    render_time = time.perf_counter() - start
+
+    sizes = [fit_size(image.size, bounds) if bounds is not None else image.size for extra, bounds, preset in targets]
+    order = sorted(range(len(targets)), key=lambda i: -sizes[i][0] * sizes[i][1])
+    executor = get_encoder(WORKERS)
+    encodes = {}
+    resize_times = {}
+    for i in order:
+        extra, bounds, preset = targets[i]
+        resize_start = time.perf_counter()
+        if image.size != sizes[i]:
+            image = image.resize(sizes[i], Image.LANCZOS, reducing_gap=3.0)
+        resize_times[i] = time.perf_counter() - resize_start
+        encodes[i] = executor.submit(encode_image, image, save_path(filepath, extra, preset, directory), preset)
+
+    files = []
+    for i in range(len(targets)):
+        path, size, encode_time = encodes[i].result()
+        files.append((path, sizes[i], size, resize_times[i], encode_time))
+    return files, render_time, time.perf_counter() - start
+
+# opens an image file as RGBA, through cache (a DecodedCache) when there is one
+def open_image(filepath, cache=None):
+    if cache is not None:
+        return cache.open(filepath)
+    return Image.open(filepath).convert("RGBA")
+
+# an image being edited, without a window: image is the current state, temp the
+# edit in progress on top of it, and update commits temp to the undo history and
+# its ops to the edit log; positions are pixels of image
+# every state in history is stored with the size it is shown at, which starts as
+# the image fitted into bounds (the image size when there is no window)
+# on_local_edit(previous temp, temp, box) is called after an edit that only
+# changed temp inside box, so a view can patch what it shows instead of redrawing
+# files are opened through cache when one is given, see cache.py
+class Session:
+    def __init__(self, filepath, bounds=None, on_local_edit=None, cache=None):
+        self.cache = cache
+        im = open_image(filepath, cache)
+        # images are never modified in place, so image, temp and the history share im
+        # a crop is only a view box over temp until temp is read, see the temp property
+        self.image = im
+        self.view = None
+        self.temp = im
+        self.filepath = filepath
+        self.on_local_edit = on_local_edit
+        self.bounds = bounds
+
+        # Save states
+        width, height = fit_size(im.size, bounds) if bounds is not None else im.size
+        self.history = History() # includes current state
+        self.history.append((im, width, height))
+        self.history_pos = 0
+
+        # edit log of every state in history, replayed on original when saving
+        # temp_ops are the ops that turn image into temp, added to the log on update
+        self.original = im
+        self.ops_history = [[]]
+        self.ops = []
+        self.temp_ops = []
+
+        # (image before, temp, box) after local edits, temp only differs from image
+        # before inside box, so only that part is stored, see set_temp_local
+        self.dirty = None
+
+        # version goes up every time image changes
+        self.version = 0
+
+        # enhancers and histograms of image and its proxies, see get_enhancer
+        self.enhancers = {}
+        self.histograms = {}
+
+        # (image, RegionIndex) for fast magic wand selections on image, see get_regions
+        self.region_index = None
+
+        # (path, bytes, render seconds, encode seconds) of every save, see record_save
+        self.saves = []
+
+    # temp with the crop view applied, the crop is only copied out the first time
+    # temp is read, so cropping and showing the crop never touch the pixels
+    @property
+    def temp(self):
+        if self.view is not None:
+            self.temp_image = self.temp_image.crop(self.view)
+            self.view = None
+        return self.temp_image
+
+    @temp.setter
+    def temp(self, image):
+        self.temp_image = image
+        self.view = None
+
+    # starts over on another file, the undo history and edit log of the old one are
+    # dropped, returns the size the new file is shown at
+    def open(self, filepath):
+        im = open_image(filepath, self.cache)
+        self.image = im
+        self.view = None
+        self.temp = im
+        self.filepath = filepath
+
+        width, height = fit_size(im.size, self.bounds) if self.bounds is not None else im.size
+        self.history.close()
+        self.history = History()
+        self.history.append((im, width, height))
+        self.history_pos = 0
+
+        self.original = im
+        self.ops_history = [[]]
+        self.ops = []
+        self.temp_ops = []
+        self.image_changed()
+        return width, height
+
+    # call after self.image is replaced, cached data of the old image is dropped
+    # temp is the new image again, so the box it differed in is dropped as well
+    def image_changed(self):
+        self.version += 1
+        self.dirty = None
+        self.enhancers.clear()
+        self.histograms.clear()
+
+    # replaces temp with image, which only differs from temp inside box
+    def set_temp_local(self, image, box):
+        previous = self.temp
+        if self.dirty is not None and self.dirty[1] is previous:
+            source = self.dirty[0]
+            self.dirty = (source, image, union_box(self.dirty[2], box))
+        else:
+            self.dirty = (previous, image, box)
+        self.temp = image
+        if self.on_local_edit is not None:
+            self.on_local_edit(previous, image, box)
+
+    # renders a slider edit of image into temp with render(image, factor)
+    def render_edit(self, mode, factor, render):
+        self.install_edit(mode, factor, render(self.image, factor))
+
+    # makes edited, image edited by a slider at factor, the new temp
+    def install_edit(self, mode, factor, edited):
+        self.temp = edited
+        if mode == 'pixelate':
+            self.temp_ops = [(mode, factor, self.image.size)]
+        else:
+            self.temp_ops = [(mode, factor)]
+
+    # returns the region index of image, or None if it is not built or has none
+    def get_regions(self, image):
+        if self.region_index is None or self.region_index[0] is not image:
+            return None
+        return self.region_index[1]
+
+    # true once build_regions has run on image, even if it gave no index
+    def has_regions(self, image):
+        return self.region_index is not None and self.region_index[0] is image
+
+    # builds the region index of image, later magic wand selections on it are fast
+    # returns None for images the index does not pay off for, see index_regions
+    def build_regions(self):
+        source = self.image
+        if not self.has_regions(source):
+            self.region_index = (source, index_regions(np.asarray(source)))
+        return self.region_index[1]
+
+    # returns an ImageEnhance object for image, created once per image
+    # creating one computes its degenerate image (a smoothed copy for sharpness,
+    # a gray copy for saturation), after that enhance(factor) is only a blend
+    def get_enhancer(self, enhancer, image):
+        key = (enhancer, image.size)
+        cached = self.enhancers.get(key)
+        if cached is None or cached[0] is not image:
+            cached = (image, enhancer(image))
+            self.enhancers[key] = cached
+        return cached[1]
+
+    # returns the histogram of image, computed once per image
+    def get_histogram(self, image):
+        cached = self.histograms.get(image.size)
+        if cached is None or cached[0] is not image:
+            cached = (image, image.histogram())
+            self.histograms[image.size] = cached
+        return cached[1]
+
+    # renders the edit log of the current state on the original image
+    # size limits the output size, by default the log is replayed at full resolution
+    def render_log(self, size=None):
+        original = self.original
+        if size is not None:
+            original = original.resize(fit_size(original.size, size), Image.BILINEAR, reducing_gap=2.0)
+        return render_ops(original, self.ops)
+
+    # saves the image, replaying the edit log once at full resolution
+    # preset is one of SAVE_PRESETS, returns the result of save_render
+    def save_image(self, extra="", preset='png'):
+        result = save_render(self.original, self.ops, save_path(self.filepath, extra, preset), preset)
+        self.record_save(result)
+        return result
+
+    # saves the image at every size in targets from a single replay of the edit
+    # log, see export_render; every file is recorded as a save
+    def export(self, targets=EXPORT_SIZES, directory=None):
+        result = export_render(self.original, self.ops, self.filepath, targets, directory)
+        self.record_export(result)
+        return result
+
+    def record_export(self, result):
+        files, render_time, total_time = result
+        for path, size, written, resize_time, encode_time in files:
+            self.record_save((path, written, render_time, encode_time))
+        print("exported %d files in %.3f s" % (len(files), total_time))
+
+    def record_save(self, result):
+        self.saves.append(result)
+        path, size, render_time, encode_time = result
+        print("saved %s  %.1f MB  rendered in %.3f s, encoded in %.3f s" % (path, size / 2**20, render_time, encode_time))
+
+    # moves to the state at pos in history, returns the size it is shown at
+    def restore(self, pos):
+        self.history_pos = pos
+        image, width, height = self.history[pos]
+
+        self.image = image
+        self.temp = image
+        self.ops = self.ops_history[pos]
+        self.temp_ops = []
+        self.image_changed()
+        return width, height
+
+    # undo the change, returns the size the restored state is shown at or None
+    def undo(self):
+        if self.history_pos > 0:
+            return self.restore(self.history_pos - 1)
+        print("Can't undo anymore")
+
+    # redo the change, returns the size the restored state is shown at or None
+    def redo(self):
+        if self.history_pos < len(self.history)-1:
+            return self.restore(self.history_pos + 1)
+        print("Can't redo anymore")
+
+    # update the image and history, temp is shown at width x height
+    def update(self, width=None, height=None):
+        if width is None or height is None:
+            width, height = self.temp.size
+
+        if self.history_pos < len(self.history)-1: # at old state
+            # keep history up to current state
+            self.history.truncate(self.history_pos + 1)
+            del self.ops_history[self.history_pos + 1:]
+
+        dirty = None
+        if self.dirty is not None and self.dirty[0] is self.image and self.dirty[1] is self.temp:
+            dirty = self.dirty[2]
+        self.history.append((self.temp, width, height), dirty)
+        self.image = self.temp
+        self.ops = self.ops + self.temp_ops
+        self.ops_history.append(self.ops)
+        self.temp_ops = []
+        self.image_changed()
+
+        self.history_pos += 1
+        print(len(self.history))
+        assert self.history_pos < len(self.history)
+        assert self.history_pos >= 0
+
+    # writes the edit log of the current state as a recipe, see load_recipe
+    def save_recipe(self, path):
+        save_recipe(self.ops, path)
+
+    # display the image in the iamge viewer
+    def show(self):
+        self.temp.show()
+
+    # image edited by a slider at factor, image is self.image or one of its proxies
+    def render_brightness(self, image, factor):
+        return apply_point_ops(image, [('brightness', factor)])
+
+    def render_contrast(self, image, factor):
+        return apply_point_ops(image, [('contrast', factor)], self.get_histogram(image))
+
+    def render_saturation(self, image, factor):
+        return enhance(self.get_enhancer(ImageEnhance.Color, image), factor)
+
+    def render_sharpness(self, image, factor):
+        return enhance(self.get_enhancer(ImageEnhance.Sharpness, image), factor)
+
+    def render_pixelate(self, image, factor):
+        return pixelate_image(image, factor, self.image.size)
+
+    # change the brightness by factor
+    # factor > 1: brighter
+    # factor = 1: original
+    # factor = 0: black
+    def change_brightness(self, factor):
+        assert factor >= 0
+        self.render_edit('brightness', factor, self.render_brightness)
+
+    # change the contrast by factor
+    # factor > 1: more contrast
+    # factor = 1: original
+    # factor = 0: gray
+    def change_contrast(self, factor):
+        assert factor >= 0
+        self.render_edit('contrast', factor, self.render_contrast)
+
+    # change the saturation by factor
+    # factor > 1: more saturation
+    # factor = 1: original
+    # factor = 0: black and white
+    def change_saturation(self, factor):
+        assert factor >= 0
+        self.render_edit('saturation', factor, self.render_saturation)
+
+    # change the sharpness by factor
+    # factor = 2: sharpened
+    # factor = 1: original
+    # factor = 0: blurry
+    def change_sharpness(self, factor):
+        assert factor >= 0
+        self.render_edit('sharpness', factor, self.render_sharpness)
+
+    # pixelates the image
+    # factor = 1: image is one giant pixel (subject to aspect ratio)
+    # factor = 0: image is normal
+    def pixelate(self, factor):
+        self.render_edit('pixelate', factor, self.render_pixelate)
+
+    # crops image to the (left, top, right, bottom) box
+    def crop(self, left, top, right, bottom):
+        width, height = self.image.size
+        # record the crop as a view over image, it is only copied out once temp is read
+        self.temp = self.image
+        self.view = tuple(int(round(border)) for border in (left, top, right, bottom))
+        self.temp_ops = [('crop', (left/width, top/height, right/width, bottom/height))]
+
+    # rotate the image by angle degrees
+    # if update_dims, update image dimensions to fit rotated image
+    # else image is cropped to original size
+    def change_rotation(self, angle=90, update_dims=True):
+        self.temp = rotate_image(self.image, angle, update_dims)
+        self.temp_ops = [('rotate', angle, update_dims)]
+
+    # applies a sticker centered on pixel (x, y) of the image
+    # stickerfp is the filepath of the sticker
+    def add_sticker(self, stickerfp, x, y):
+        width, height = self.image.size
+        sticker = Image.open(stickerfp).convert("RGBA")
+        w, h = sticker.size
+
+        # paste uses top left corner, so we need to offset to place in the center
+        new_x, new_y = x - (w//2), y - (h//2)
+        assert(new_x >= 0)
+        assert(new_y >= 0)
+
+        location = (new_x, new_y)
+        copy = self.temp.copy()
+        copy.paste(sticker, location, sticker)
+        box = (new_x, new_y, min(new_x + w, width), min(new_y + h, height))
+        self.set_temp_local(copy, box)
+        self.temp_ops = self.temp_ops + [('sticker', stickerfp, x/width, y/height, width)]
+
+    # selects all neighboring pixels with the same color as pixel (x, y) with threshold
+    # returns an (h, w) boolean mask where True marks a selected pixel
+    def magic_wand(self, x, y, threshold = .5):
+        regions = self.get_regions(self.temp)
+        if regions is not None:
+            return regions.select(x, y, threshold)
+        return flood_fill_mask(np.asarray(self.temp), x, y, threshold)
+
+    # selects all pixels colored like pixel (x, y)
+    # returns an (h, w) boolean mask where True marks a selected pixel
+    def select_similar_pixels(self, x, y, threshold = .5):
+        data = np.asarray(self.temp)
+        return similar_color_mask(data, data[y, x], threshold)
+
+    # applies fn(data, mask) to a writable copy of temp and stores the result
+    # temp is replaced rather than modified since it may be shared with history
+    def apply_mask(self, mask, fn):
+        data = np.array(self.temp)
+        mask = as_mask(mask, data.shape)
+        fn(data, mask)
+        self.set_temp_local(Image.fromarray(data, 'RGBA'), mask_box(mask))
+
+    # makes all pixels that are selected in mask transparent
+    def make_transparent(self, mask):
+        self.apply_mask(mask, lambda data, m: fill_mask(data, m, (255, 255, 255, 0)))
+        mask = as_mask(mask, (self.temp.size[1], self.temp.size[0]))
+        self.temp_ops = self.temp_ops + [('transparent', np.packbits(mask), mask.shape)]
+
+    # inverts the colors on the image, keeping transparency
+    def invert(self):
+        self.temp = apply_point_ops(self.temp, [('invert',)])
+        self.temp_ops = self.temp_ops + [('invert',)]
+
+    # converts colors to grayscale, keeping transparency
+    def grayscale(self):
+        self.temp = apply_point_ops(self.temp, [('grayscale',)])
+        self.temp_ops = self.temp_ops + [('grayscale',)]
+
+    # returns true if edit state is at the beginning of the history, else false
+    def is_original_image(self):
+        return self.history_pos == 0
+
+    # returns true if edit state is at the end of the history, else false
+    def is_latest_image(self):
+        return self.history_pos == (len(self.history) - 1)
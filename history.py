@@ -0,0 +1,225 @@
+import os, shutil, tempfile, weakref, zlib
+from hashlib import blake2b
+from collections import OrderedDict
+
+from PIL import Image
+import numpy as np
+
+# edge length in pixels of the square tiles snapshots are split into
+TILE_SIZE = 256
+
+# bytes of tile data kept in memory before cold states are spilled to disk
+HISTORY_BYTES = 512 * 2**20
+
+# number of whole images kept around so stepping to a neighbouring state is instant
+RECENT_IMAGES = 3
+
+# undo history that stores every state as a grid of tiles
+# tiles are shared between states by content hash, so an edit that only touches
+# part of the image (a sticker, a transparent region) only stores the tiles it changed
+# once the tiles in memory go over max_bytes, tiles only used by states far away
+# from the current one are compressed to a temporary directory on disk
+#
+# history[i] returns (image, width, height) like the list of tuples it replaces
+class History:
+    def __init__(self, max_bytes=HISTORY_BYTES, tile_size=TILE_SIZE, recent_images=RECENT_IMAGES):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.recent_images = recent_images
+
+        # states are (state_id, mode, size, tiles, width, height)
+        # tiles is a list of (x, y, tile hash) covering the image
+        self.states = []
+        self.next_id = 0
+        self.current = 0
+
+        # tile hash -> [data or None if spilled, shape, number of states using it]
+        self.tiles = {}
+        self.memory_bytes = 0
+        self.spill_dir = None
+
+        # state_id -> image for the most recently used states
+        self.recent = OrderedDict()
+
+    def __len__(self):
+        return len(self.states)
+
+    def __getitem__(self, pos):
+        if pos < 0:
+            pos += len(self.states)
+        state_id, mode, size, tiles, width, height = self.states[pos]
+        self.current = pos
+
+        image = self.recent.get(state_id)
+        if image is None:
+            image = self.assemble(mode, size, tiles)
+        self.remember(state_id, image)
+        return image, width, height
+
+    # adds a new state at the end of the history
+    # dirty is a (left, top, right, bottom) box the image is known to only differ from
+    # the last state in, tiles outside it are taken from the last state without looking
+    def append(self, state, dirty=None):
+        image, width, height = state
+        mode = image.mode
+
+        # most edits leave most tiles alone, so compare against the previous
+        # state first and only hash the tiles that actually changed
+        previous = None
+        if self.states and self.states[-1][1:3] == (mode, image.size):
+            previous = self.states[-1][3]
+        else:
+            dirty = None
+
+        # only the tiles around dirty are read out of the image
+        size = self.tile_size
+        region = (0, 0) + image.size
+        if dirty is not None:
+            region = (dirty[0]//size*size, dirty[1]//size*size,
+                      min(-(-dirty[2]//size)*size, image.size[0]), min(-(-dirty[3]//size)*size, image.size[1]))
+        data = np.asarray(image.crop(region) if region != (0, 0) + image.size else image)
+        if data.ndim == 2:
+            data = data[..., None]
+
+        tiles = []
+        for y in range(0, image.size[1], size):
+            for x in range(0, image.size[0], size):
+                if not (region[0] <= x < region[2] and region[1] <= y < region[3]):
+                    key = previous[len(tiles)][2]
+                    self.tiles[key][2] += 1
+                    tiles.append((x, y, key))
+                    continue
+
+                tile = data[y-region[1]:y-region[1]+size, x-region[0]:x-region[0]+size]
+                if previous is not None and self.same_tile(tile, previous[len(tiles)][2]):
+                    key = previous[len(tiles)][2]
+                    self.tiles[key][2] += 1
+                else:
+                    key = self.store_tile(tile)
+                tiles.append((x, y, key))
+
+        state_id = self.next_id
+        self.next_id += 1
+        self.states.append((state_id, mode, image.size, tiles, width, height))
+        self.current = len(self.states) - 1
+        self.remember(state_id, image)
+        self.enforce_budget()
+
+    # drops every state from pos onwards
+    def truncate(self, pos):
+        for state_id, mode, size, tiles, width, height in self.states[pos:]:
+            self.recent.pop(state_id, None)
+            for x, y, key in tiles:
+                self.release_tile(key)
+        del self.states[pos:]
+        self.current = min(self.current, len(self.states) - 1)
+
+    # total bytes of tile data currently held in memory
+    def memory_usage(self):
+        return self.memory_bytes
+
+    # removes the on-disk spill directory
+    def close(self):
+        if self.spill_dir is not None:
+            self.cleanup()
+            self.spill_dir = None
+
+    # adds a reference to the tile, storing it if no state has the same tile yet
+    # returns the key of the tile, which is its shape and content hash
+    def store_tile(self, tile):
+        data = tile.tobytes()
+        key = '%dx%dx%d_' % tile.shape + blake2b(data, digest_size=16).hexdigest()
+        entry = self.tiles.get(key)
+        if entry is None:
+            self.tiles[key] = [data, tile.shape, 1]
+            self.memory_bytes += len(data)
+        else:
+            entry[2] += 1
+        return key
+
+    # true if tile is the same as the stored tile key, without touching the disk
+    def same_tile(self, tile, key):
+        data, shape, __ = self.tiles[key]
+        if data is None or shape != tile.shape:
+            return False
+        return np.array_equal(tile, np.frombuffer(data, dtype=np.uint8).reshape(shape))
+
+    # drops a reference to the tile, deleting it once no state uses it
+    def release_tile(self, key):
+        entry = self.tiles[key]
+        entry[2] -= 1
+        if entry[2] > 0:
+            return
+        if entry[0] is not None:
+            self.memory_bytes -= len(entry[0])
+        if self.spill_dir is not None and os.path.exists(self.tile_path(key)):
+            os.remove(self.tile_path(key))
+        del self.tiles[key]
+
+    # returns the raw bytes of a tile, reading it back from disk if it was spilled
+    def load_tile(self, key):
+        entry = self.tiles[key]
+        if entry[0] is None:
+            with open(self.tile_path(key), 'rb') as f:
+                entry[0] = zlib.decompress(f.read())
+            self.memory_bytes += len(entry[0])
+        return entry[0]
+
+    # stitches the tiles of a state back into an image
+    def assemble(self, mode, size, tiles):
+        channels = len(Image.new(mode, (1, 1)).getbands())
+        data = np.empty((size[1], size[0], channels), dtype=np.uint8)
+        for x, y, key in tiles:
+            shape = self.tiles[key][1]
+            tile = np.frombuffer(self.load_tile(key), dtype=np.uint8).reshape(shape)
+            data[y:y+shape[0], x:x+shape[1]] = tile
+        if channels == 1:
+            data = data[..., 0]
+        image = Image.fromarray(data, mode)
+        self.enforce_budget()
+        return image
+
+    # keeps image as one of the recently used whole images
+    def remember(self, state_id, image):
+        self.recent[state_id] = image
+        self.recent.move_to_end(state_id)
+        while len(self.recent) > self.recent_images:
+            self.recent.popitem(last=False)
+
+    # spills tiles of the states furthest from the current one until the tiles
+    # in memory fit in max_bytes; tiles of the current state and its neighbours stay
+    def enforce_budget(self):
+        if self.memory_bytes <= self.max_bytes:
+            return
+
+        hot = set()
+        for pos in range(self.current - 1, self.current + 2):
+            if 0 <= pos < len(self.states):
+                hot.update(key for x, y, key in self.states[pos][3])
+
+        order = sorted(range(len(self.states)), key=lambda pos: -abs(pos - self.current))
+        for pos in order:
+            for x, y, key in self.states[pos][3]:
+                if key not in hot:
+                    self.spill_tile(key)
+                if self.memory_bytes <= self.max_bytes:
+                    return
+
+    # compresses a tile to disk and frees its memory
+    def spill_tile(self, key):
+        entry = self.tiles[key]
+        if entry[0] is None:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='fotofix_history_')
+            self.cleanup = weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+        path = self.tile_path(key)
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(zlib.compress(entry[0], 1))
+        self.memory_bytes -= len(entry[0])
+        entry[0] = None
+
+    def tile_path(self, key):
+        return os.path.join(self.spill_dir, key)
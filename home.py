@@ -1,4 +1,3 @@
-import glob
 import sys, os, math, time
 sys.path.insert(0, os.path.abspath('..'))
 
@@ -11,6 +10,7 @@ from kivy.core.image import Image as CoreImage
 from kivy.uix.label import Label
 
 from hand import Hand, kLeapRange
+from batch import gallery_images
 import photo_editor
 
 class Homepage(Screen) :
@@ -22,7 +22,7 @@ class Homepage(Screen) :
         self.add_widget(self.title)
 
         self.buttons = []
-        photo_paths = [f for f in (glob.glob("./images/*.jpg") + glob.glob("./images/*.jpeg") + glob.glob("./images/*.png"))]
+        photo_paths = gallery_images()
         for i, path in enumerate(photo_paths):
             button = SensorButtonPhoto(mode='hover', texture=CoreImage(path).texture, path=path)
             self.canvas.add(button)
@@ -40,7 +40,7 @@ class Homepage(Screen) :
             self.canvas.remove(button)
 
         self.buttons = []
-        photo_paths = [f for f in (glob.glob("./images/*.jpg") + glob.glob("./images/*.jpeg") + glob.glob("./images/*.png"))]
+        photo_paths = gallery_images()
         for i, path in enumerate(photo_paths):
             button = SensorButtonPhoto(mode='hover', texture=CoreImage(path).texture, path=path)
             self.canvas.add(button)
@@ -53,7 +53,7 @@ class Homepage(Screen) :
         self.title.center_y = 9*Window.height/10
         self.title.font_size = str(Window.width//30) + 'sp'
 
-        photo_paths = [f for f in (glob.glob("./images/*.jpg") + glob.glob("./images/*.jpeg") + glob.glob("./images/*.png"))]
+        photo_paths = gallery_images()
         dim = self.getDimension(len(photo_paths)-1)
         dim_size = min(Window.width, Window.height*8/10)
         for i in range(len(self.buttons)):
@@ -0,0 +1,165 @@
+import threading, time, traceback
+from collections import deque
+
+# raised inside a job's work function once the job has been cancelled
+class JobCancelled(Exception):
+    pass
+
+# the job running on the current thread, if any
+local = threading.local()
+
+# long running work calls this now and then to stop early once it is superseded
+def check_cancelled():
+    job = getattr(local, 'job', None)
+    if job is not None and job.cancelled:
+        raise JobCancelled()
+
+class Job:
+    def __init__(self, key, work, done):
+        self.key = key
+        self.work = work
+        self.done = done
+        self.cancelled = False
+
+        # timestamps, in seconds from time.perf_counter
+        self.queued_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self.install_time = 0
+
+        # set once the work has run, or the job was dropped before it could
+        self.ended = threading.Event()
+
+    # blocks until the work has run or the job was dropped, or timeout seconds have passed
+    # the done callback is still dispatched as usual
+    def wait(self, timeout=None):
+        return self.ended.wait(timeout)
+
+    # time spent waiting in the queue before the job started
+    def wait_time(self):
+        return self.started_at - self.queued_at
+
+    # time spent running the work function on the worker thread
+    def run_time(self):
+        return self.finished_at - self.started_at
+
+# runs jobs one at a time on a background thread, in the order they were submitted
+# jobs submitted with the same key coalesce: a new job replaces any queued job with
+# that key and cancels it if it is already running, so only the latest one finishes
+# done(result) is handed to dispatch, which should call it on the main thread
+class JobScheduler:
+    def __init__(self, dispatch=None, history=120):
+        self.dispatch = dispatch if dispatch is not None else (lambda fn: fn())
+        self.queue = deque()
+        self.lock = threading.Condition()
+        self.running = None
+        self.closed = False
+
+        # the most recently finished jobs, for timing
+        self.finished = deque(maxlen=history)
+
+        self.thread = threading.Thread(target=self.run, name='fotofix-jobs', daemon=True)
+        self.thread.start()
+
+    # queues work() to run in the background, returns the job
+    def submit(self, key, work, done=None):
+        job = Job(key, work, done)
+        with self.lock:
+            if key is not None:
+                self.cancel_locked(key)
+            self.queue.append(job)
+            self.lock.notify_all()
+        return job
+
+    # cancels the queued and running jobs with key
+    def cancel(self, key):
+        with self.lock:
+            self.cancel_locked(key)
+
+    def cancel_locked(self, key):
+        for queued in [job for job in self.queue if job.key == key]:
+            queued.cancelled = True
+            queued.ended.set()
+            self.queue.remove(queued)
+        if self.running is not None and self.running.key == key:
+            self.running.cancelled = True
+
+    # true while there are queued or running jobs
+    def busy(self):
+        with self.lock:
+            return bool(self.queue) or self.running is not None
+
+    # blocks until every queued job has run, or timeout seconds have passed
+    def wait(self, timeout=None):
+        with self.lock:
+            return self.lock.wait_for(lambda: not self.queue and self.running is None, timeout)
+
+    # stops the worker thread, queued jobs are cancelled unless finish is true, in
+    # which case they still run first
+    def close(self, finish=False):
+        with self.lock:
+            self.closed = True
+            if not finish:
+                for job in self.queue:
+                    job.cancelled = True
+                    job.ended.set()
+                self.queue.clear()
+                if self.running is not None:
+                    self.running.cancelled = True
+            self.lock.notify_all()
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.queue or self.closed)
+                if not self.queue:
+                    return
+                job = self.queue.popleft()
+                self.running = job
+
+            job.started_at = time.perf_counter()
+            local.job = job
+            result = None
+            try:
+                result = job.work()
+            except JobCancelled:
+                job.cancelled = True
+            except Exception:
+                traceback.print_exc()
+                job.cancelled = True
+            local.job = None
+            job.finished_at = time.perf_counter()
+            job.ended.set()
+
+            if not job.cancelled:
+                self.dispatch(lambda job=job, result=result: self.finish(job, result))
+
+            # the worker keeps no reference to the job, or to what its work holds,
+            # while it waits for the next one
+            job = result = None
+            with self.lock:
+                self.running = None
+                self.lock.notify_all()
+
+    # runs on the main thread
+    def finish(self, job, result):
+        if job.cancelled:
+            return
+        start = time.perf_counter()
+        if job.done is not None:
+            job.done(result)
+        job.install_time = time.perf_counter() - start
+        # only the timings are kept, work and done usually hold on to whoever submitted the job
+        job.work = job.done = None
+        self.finished.append(job)
+        print("job %s waited %.3f s, ran %.3f s, installed in %.3f s" % (job.key, job.wait_time(), job.run_time(), job.install_time))
+
+    # average queue wait, run time and main thread install time of recent jobs
+    def average_times(self):
+        jobs = list(self.finished)
+        if not jobs:
+            return 0, 0, 0
+        n = len(jobs)
+        return (sum(job.wait_time() for job in jobs) / n,
+                sum(job.run_time() for job in jobs) / n,
+                sum(job.install_time for job in jobs) / n)
@@ -1,24 +1,27 @@
 import sys, os
 sys.path.insert(0, os.path.abspath('..'))
 
-from common.core import BaseWidget, run, lookup
-from common.screen import ScreenManager, Screen
+# the app is only built when main.py is run: the worker processes that replay edits
+# on other photos (see start_batch in batch.py) import this module as well and must
+# not open a window of their own
+if __name__ == "__main__":
+    from common.core import BaseWidget, run, lookup
+    from common.screen import ScreenManager, Screen
 
-from kivy.core.window import Window
+    from kivy.core.window import Window
 
-import photo_editor
-from settings import Settings
-from home import Homepage
+    import photo_editor
+    from settings import Settings
+    from home import Homepage
 
-# Makes window open full screen
-Window.fullscreen = 'auto'
+    # Makes window open full screen
+    Window.fullscreen = 'auto'
 
-sm = ScreenManager()
-sm.add_screen(Homepage(name='home'))
-sm.add_screen(photo_editor.PhotoEditor(name='photo_editor', sm=sm ))
-sm.add_screen(Settings(name='settings'))
+    sm = ScreenManager()
+    sm.add_screen(Homepage(name='home'))
+    sm.add_screen(photo_editor.PhotoEditor(name='photo_editor', sm=sm ))
+    sm.add_screen(Settings(name='settings'))
 
-if __name__ == "__main__":
     if (len(sys.argv) >= 2): # ['main.py', 'filepath', '...']
         _, filepath = sys.argv[:2]
         photo_editor.filepath = filepath
@@ -14,16 +14,19 @@ from kivy.graphics.instructions import InstructionGroup
 from kivy.uix.label import Label
 
 import threading
-from kivy.clock import mainthread
+from kivy.clock import mainthread, Clock
 
 import commands
 from hand import Hand, kLeapRange
 from picture import Picture
+from batch import start_batch, gallery_images, is_output
 from graphics import Slider, Overlay, StickerBar, IconBar
 import speech
 
 
 transparency_threshold = .95
+# format and quality of saved images, one of engine.SAVE_PRESETS, picked in settings
+save_preset = 'png'
 speech_deltas = {
     'slider': 0.1,
     'zoom': 0.07,
@@ -98,6 +101,11 @@ class PhotoEditor(Screen) :
         self.sticker_bar = StickerBar(self.sticker_label)
         self.add_widget(self.sticker_label)
 
+        # progress of saves and of replaying the edits on the other photos
+        self.status_label = Label()
+        self.add_widget(self.status_label)
+        self.replay_thread = None
+
         # settings button
         self.settings_button = SensorButton(size=(Window.width/15, Window.width/15), pos=(0.97*Window.width-Window.width/15, 0.98*Window.height-Window.width/15), mode='hover', texture=CoreImage('icons/settings.png').texture)
         self.canvas.add(self.settings_button)
@@ -119,6 +127,7 @@ class PhotoEditor(Screen) :
         if self.sm.recent_screen == 'home':
             if self.picture in self.canvas.children:
                 self.canvas.remove(self.picture)
+                self.picture.close()
                 self.picture = Picture(filepath)
                 self.canvas.add(Color(1,1,1,1))
                 self.canvas.add(self.picture)
@@ -151,10 +160,12 @@ class PhotoEditor(Screen) :
 
         if DARK_MODE:
             self.sticker_label.color = (1,1,1,1)
+            self.status_label.color = (1,1,1,1)
             self.icon_label.color = (1,1,1,1)
             self.mode_instructions_label.color = (1,1,1,1)
         else:
             self.sticker_label.color = (0,0,0,1)
+            self.status_label.color = (0,0,0,1)
             self.icon_label.color = (0,0,0,1)
             self.mode_instructions_label.color = (0,0,0,1)
 
@@ -317,13 +328,9 @@ class PhotoEditor(Screen) :
         ######################################
         if self.mode == 'rotate' and len(active_hands) == 1:
             if all([state == None for state in active_hands[0].recent_turn_states]) and active_hands[0].turn_state == 'right':
-                self.picture.change_rotation(angle=90, update_dims=True)
-                self.picture.on_update()
-                self.picture.update()
+                self.picture.change_rotation_async(angle=90, update_dims=True)
             elif all([state == None for state in active_hands[0].recent_turn_states]) and active_hands[0].turn_state == 'left':
-                self.picture.change_rotation(angle=-90, update_dims=True)
-                self.picture.on_update()
-                self.picture.update()
+                self.picture.change_rotation_async(angle=-90, update_dims=True)
 
         ######################################
         ##               ZOOM               ##
@@ -345,8 +352,13 @@ class PhotoEditor(Screen) :
 
 
     def update_slider(self, active_hands=[], keyword=None):
+        global transparency_threshold
+        # while a transparency preview is on, the slider tunes the threshold
+        slider_mode = self.mode in self.slider_modes or \
+            (self.mode == 'transparent' and self.picture.threshold_request is not None)
+
         # update slider value if in slider self.mode and 1 hand is engaged (i.e. z < 0.6)
-        if (self.mode in self.slider_modes) and \
+        if slider_mode and \
             (len(active_hands) == 1 or keyword in commands.slider_commands):
             # add green slider knob
             self.slider_group.remove_all()
@@ -379,12 +391,15 @@ class PhotoEditor(Screen) :
                 self.picture.pixelate(normalized_x)
             # if self.mode == 'rotate':
             #     self.picture.change_rotation(angle=90*(self.slider.value-1), update_dims=False)
+            elif self.mode == 'transparent':
+                transparency_threshold = round(percent, 2)
+                self.picture.preview_threshold(transparency_threshold)
             elif self.mode in self.slider_modes:
                 # works for change_contrast, change_brightness, change_sharpness, change_saturation
                 eval('self.picture.change_' + self.mode + '(' + str(self.slider.value) + ')')
             self.picture.on_update()
 
-        elif (self.mode in self.slider_modes):
+        elif slider_mode:
             # add yellow slider knob
             self.slider_group.remove_all()
             self.slider_group.add(self.slider_line)
@@ -486,6 +501,11 @@ class PhotoEditor(Screen) :
         self.mode_instructions_label.center_y = 19*Window.height/20
         self.mode_instructions_label.font_size = str(Window.width//170) + 'sp'
 
+        # update status label
+        self.status_label.center_x = Window.width/2
+        self.status_label.center_y = Window.height/20
+        self.status_label.font_size = str(Window.width//120) + 'sp'
+
 
     # maps key presses to changing editing self.mode
     # to be replaced by speech commands in V2
@@ -501,6 +521,11 @@ class PhotoEditor(Screen) :
         if keyword in commands.terminator:
             sys.exit()
 
+        # replay is an action rather than a mode, the current mode carries on
+        if keyword == 'replay':
+            self.replay_edits()
+            return
+
         # TODO: if you call undo just once it sometimes doesn't work the first time
         if self.mode == 'undo':
             self.picture.undo()
@@ -512,7 +537,7 @@ class PhotoEditor(Screen) :
             self.picture.on_update()
             self.overlay.update_pos_and_size(self.picture.rectangle.size, self.picture.rectangle.pos)
 
-        elif self.mode in self.slider_modes and keyword in commands.slider_commands:
+        elif (self.mode in self.slider_modes or self.mode == 'transparent') and keyword in commands.slider_commands:
             self.update_slider(keyword=keyword)
 
         elif self.mode == 'zoom' and keyword in commands.zoom_commands:
@@ -524,8 +549,12 @@ class PhotoEditor(Screen) :
             if old_mode == 'zoom':
                 self.overlay.update_pos_and_size(self.picture.rectangle.size, self.picture.rectangle.pos)
 
-            # update slider to default value to start fresh next time
-            if old_mode in self.slider_modes:
+            if old_mode == 'transparent':
+                self.picture.end_threshold_preview()
+
+            # update slider to default value to start fresh next time, the
+            # transparency preview moves it as well
+            if old_mode in self.slider_modes or old_mode == 'transparent':
                 percent = self.slider.change_value(1.0)
                 self.slider_knob.cpos=(self.slider_knob.cpos[0], Window.height*(0.96*percent + 0.02))
 
@@ -543,6 +572,10 @@ class PhotoEditor(Screen) :
             # update image history with changes
             self.picture.update() # TODO: (fix) currently this updates history every time a self.mode is changed, even if the photo is not modified while in that self.mode
 
+            # index the image for the magic wand while the user picks a spot
+            if self.mode == 'transparent':
+                self.picture.prepare_regions()
+
         # if current mode is sticker, add a sticker based on its name
         if self.mode == 'sticker':
             if self.sticker_bar not in self.canvas.children:
@@ -562,21 +595,26 @@ class PhotoEditor(Screen) :
             self.canvas.remove(self.sticker_bar)
 
         if self.mode == 'transparent':
-            if keyword == "apply":
+            # while a preview is on, pointing tunes the threshold, so apply goes to
+            # where the preview was started
+            if keyword == "apply" and self.picture.threshold_request is not None:
+                self.picture.apply_threshold_preview(transparency_threshold)
+            elif keyword == "apply" or keyword == "preview":
                 screen_hands = list(filter(lambda h: not h.id == -1, self.hands))
                 if len(screen_hands) == 1 and self.picture.rectangle.pos[0] < screen_hands[0].pos[0]*Window.width < self.picture.rectangle.pos[0] + self.picture.rectangle.size[0] and self.picture.rectangle.pos[1] < screen_hands[0].pos[1]*Window.height < self.picture.rectangle.pos[1] + self.picture.rectangle.size[1]:
                     x = screen_hands[0].pos[0]*Window.width - self.picture.rectangle.pos[0]
                     y = screen_hands[0].pos[1]*Window.height - self.picture.rectangle.pos[1]
-                    mask = self.picture.magic_wand(x, y, transparency_threshold)
-                    self.picture.make_transparent(mask)
-                    self.picture.on_update()
-                    self.picture.update()
+                    if keyword == "apply":
+                        self.picture.make_transparent_async(x, y, transparency_threshold)
+                    else:
+                        # start the slider at the current threshold
+                        percent = self.slider.change_value(transparency_threshold*self.slider.max_val)
+                        self.slider_knob.cpos=(self.slider_knob.cpos[0], Window.height*(0.96*percent + 0.02))
+                        self.picture.start_threshold_preview(x, y, transparency_threshold)
 
         if self.mode == 'rotate':
             if old_mode == "rotate":
-                self.picture.change_rotation(angle=90, update_dims=True)
-                self.picture.on_update()
-                self.picture.update()
+                self.picture.change_rotation_async(angle=90, update_dims=True)
 
         elif self.mode == 'invert':
             self.picture.invert()
@@ -588,6 +626,70 @@ class PhotoEditor(Screen) :
             self.picture.on_update()
             self.picture.update()
 
-        # if current mode is save, save the image
+        # if current mode is save, save the image in the background
         if self.mode == 'save':
-            self.picture.save_image()
+            self.status_label.text = 'Saving...'
+            self.picture.save_image_async(preset=save_preset, done=self.on_saved, failed=self.on_save_failed)
+
+    # replays the edit log of the picture on the other photos in the gallery, on a
+    # pool of background processes, one core is left to the ui
+    # edited copies are saved next to the originals like save_image does
+    def replay_edits(self):
+        if self.replay_thread is not None and self.replay_thread.is_alive():
+            print("Still applying edits to other photos")
+            return
+
+        ops = self.picture.ops
+        current = os.path.abspath(self.picture.filepath)
+        paths = [path for path in gallery_images() if not is_output(path) and os.path.abspath(path) != current]
+        if not ops or not paths:
+            self.status_label.text = 'No edits to apply' if not ops else 'No other photos to edit'
+            Clock.schedule_once(lambda dt: self.clear_status_label(), 5)
+            return
+
+        self.replay_total = len(paths)
+        self.replay_done = 0
+        self.replay_failed = 0
+        self.replay_start = time.perf_counter()
+        self.status_label.text = 'Applying edits to other photos: 0 / %d' % self.replay_total
+        self.replay_thread = start_batch(paths, ops, self.on_replay_result, self.on_replay_finished, workers=max((os.cpu_count() or 1) - 1, 1), preset=save_preset)
+
+    # called for every photo the replay is done with
+    @mainthread
+    def on_replay_result(self, result):
+        path, new_path, size_in, size_out, seconds, error = result
+        self.replay_done += 1
+        if error is not None:
+            self.replay_failed += 1
+            print("failed %s: %s" % (path, error))
+        self.status_label.text = 'Applying edits to other photos: %d / %d' % (self.replay_done, self.replay_total)
+
+    # called once the replay is over, error is set if it stopped before every photo was done
+    @mainthread
+    def on_replay_finished(self, error):
+        self.replay_thread = None
+        # photos the replay never got to count as failed
+        self.replay_failed += self.replay_total - self.replay_done
+        elapsed = time.perf_counter() - self.replay_start
+        print("replayed edits on %d photos, %d failed  %6.1f s" % (self.replay_total, self.replay_failed, elapsed))
+        if error is not None:
+            self.status_label.text = 'Could not apply edits to other photos'
+        else:
+            self.status_label.text = 'Edits applied to %d photos' % (self.replay_total - self.replay_failed)
+        if self.replay_failed:
+            self.status_label.text += ', %d failed' % self.replay_failed
+        Clock.schedule_once(lambda dt: self.clear_status_label(), 5)
+
+    def clear_status_label(self):
+        if self.replay_thread is None:
+            self.status_label.text = ''
+
+    # called once a save is written, result is (path, bytes, render seconds, encode seconds)
+    def on_saved(self, result):
+        path, size, render_time, encode_time = result
+        self.status_label.text = 'Saved %s (%.1f MB)' % (os.path.basename(path), size / 2**20)
+        Clock.schedule_once(lambda dt: self.clear_status_label(), 5)
+
+    def on_save_failed(self, error):
+        self.status_label.text = 'Saving failed: %s' % error
+        Clock.schedule_once(lambda dt: self.clear_status_label(), 5)
@@ -1,150 +1,563 @@
-import sys, os
+import sys, os, time, weakref
 sys.path.insert(0, os.path.abspath('..'))
 
 from kivy.core.window import Window
-from kivy.graphics import Rectangle, Rotate, PushMatrix, PopMatrix
+from kivy.graphics import Rectangle, Rotate, PushMatrix, PopMatrix, Color
 from kivy.graphics.instructions import InstructionGroup
-from kivy.core.image import Image as CoreImage
+from kivy.graphics.texture import Texture
+from kivy.clock import Clock
 
-from io import BytesIO
-from PIL import Image, ImageEnhance, ImageOps
+from collections import deque, OrderedDict
+from PIL import Image
 import numpy as np
 
-# helper functions
-def get_color(data, x, y, w):
-    return data[get_index(x, y, w)]
-
-def is_similar_color(a, b, threshold = .5):
-    assert(threshold >= 0 and threshold <= 1)
-
-    max_delta = (((255**2) * 3)**.5) * (1 - threshold)
-    distance = (a[0] - b[0])**2 + (a[1] - b[1])**2 + (a[2] - b[2])**2
-    distance = distance**.5
-    return distance <= max_delta
-
-def get_index(x, y, width):
-    return y*width + x
-
-# yields indexes for all pixels in the "megapixel"
-# starting from x, y and having h height / w width
-# imwidth is the total width
-def pixels_from_square(x, y, h, w, imheight, imwidth):
-    for j in range(x*h, min((x+1)*h, imheight)):
-        for i in range(y*w, min((y+1)*w, imwidth)):
-            yield j, i
-
+from jobs import JobScheduler
+from cache import DecodedCache
+from engine import Session, Pyramid, LRUCache, index_regions, fit_size, quantize, rotate_image, save_path, save_render
+from engine import EXPORT_SIZES, export_render
+from engine import flood_fill_mask, fill_mask, as_mask, mask_box, intersect_box
+
+# decoded images of the files pictures open, so reopening a photo is a memory map
+decoded_images = DecodedCache()
+
+# number of image pyramids kept by a Picture, enough for image, temp and the one before
+PYRAMIDS = 3
+
+# slider previews are cached per quantized factor, in steps of PREVIEW_STEP
+# and up to PREVIEW_CACHE_BYTES of rendered previews
+PREVIEW_STEP = 0.01
+PREVIEW_CACHE_BYTES = 256 * 2**20
+
+# selections of a transparency threshold preview are cached up to this many bytes
+THRESHOLD_CACHE_BYTES = 64 * 2**20
+
+# images wider or taller than this are shown as a grid of textures, 4096 works on most gl drivers
+MAX_TEXTURE_SIZE = 4096
+
+# edge length in pixels of the texture tiles big images are split into
+TEXTURE_TILE_SIZE = 1024
+
+# bytes of uploaded texture tiles kept around for panning and zooming back
+TILE_CACHE_BYTES = 512 * 2**20
+
+# (left, top, right, bottom) boxes of the grid of tiles covering an image of size
+def tile_boxes(size, tile_size):
+    return [(x, y, min(x + tile_size, size[0]), min(y + tile_size, size[1]))
+            for y in range(0, size[1], tile_size)
+            for x in range(0, size[0], tile_size)]
+
+# uploads a PIL image into a new texture
+def make_texture(image):
+    image = image if image.mode == 'RGBA' else image.convert('RGBA')
+    texture = Texture.create(size=image.size, colorfmt='rgba', bufferfmt='ubyte')
+    # PIL rows go top to bottom but texture rows go bottom to top
+    texture.flip_vertical()
+    texture.blit_buffer(image.tobytes(), colorfmt='rgba', bufferfmt='ubyte')
+    return texture
+
+# texture coordinates that show box of a vertically flipped texture of size
+def box_tex_coords(size, box):
+    left, right = box[0] / size[0], box[2] / size[0]
+    top, bottom = box[1] / size[1], box[3] / size[1]
+    return (left, bottom, right, bottom, right, top, left, top)
+
+def texture_bytes(entry):
+    return entry[1].size[0] * entry[1].size[1] * 4
+
+# attributes of the session that a Picture reads and writes as its own
+def session_attribute(name):
+    return property(lambda self: getattr(self.session, name),
+                    lambda self, value: setattr(self.session, name, value))
+
+# kivy view of an editing Session: draws temp, previews slider edits on proxies
+# and runs slow edits in the background, the pixels are all handled by the session
 class Picture(InstructionGroup):
+    image = session_attribute('image')
+    temp = session_attribute('temp')
+    temp_image = session_attribute('temp_image')
+    view = session_attribute('view')
+    filepath = session_attribute('filepath')
+    history = session_attribute('history')
+    history_pos = session_attribute('history_pos')
+    original = session_attribute('original')
+    ops = session_attribute('ops')
+    ops_history = session_attribute('ops_history')
+    temp_ops = session_attribute('temp_ops')
+    version = session_attribute('version')
+    region_index = session_attribute('region_index')
+
     def __init__(self, filepath):
         super(Picture, self).__init__()
 
-        im = Image.open(filepath).convert("RGBA")
-        self.image = im.copy()
-        self.temp = im.copy()
-        self.filepath = filepath
-
-        # Save states
-        self.history = [(im, im.size[0], im.size[1])] # includes current state
-        self.history_pos = 0
-
-        # Size and graphics
-        width, height = self.image.size
+        # Size and graphics, images bigger than the window are shown scaled down
+        self.session = Session(filepath, (Window.width, Window.height), self.patch_pyramid, decoded_images)
+        width, height = fit_size(self.image.size, (Window.width, Window.height))
         pos=(Window.width - width)//2, (Window.height - height)//2
         size=(width, height)
 
-        # allow rotation:
+        # slider edits are previewed on a downscaled proxy of image and only
+        # rendered at full resolution when committed, see preview_edit
+        # proxies and the displayed texture come from image pyramids, see get_pyramid
+        self.pyramids = OrderedDict()
+        self.preview = None
+        self.pending = None
+
+        # (image, mode, factor, rendered, job) of a slider edit rendering at full
+        # resolution on the job thread, until it is installed, see commit_pending
+        self.committing = None
+        self.regions_wanted = False
+
+        # previews are cached per version of image
+        self.preview_cache = LRUCache(PREVIEW_CACHE_BYTES)
+
+        # slow edits run in the background, results are installed on the main thread
+        self.jobs = JobScheduler(dispatch=lambda fn: Clock.schedule_once(lambda dt: fn()))
+        self.rotation_request = None
+
+        # (temp, proxy, x, y, seed) of a live transparency threshold preview, with x, y
+        # the seed on the proxy and seed the pixel of temp it came from
+        # threshold_request is set while one is on, see start_threshold_preview
+        # the selection of every threshold previewed is kept in threshold_masks
+        self.threshold_request = None
+        self.threshold_masks = LRUCache(THRESHOLD_CACHE_BYTES, size_of=lambda mask: mask.nbytes)
+        self.threshold_wanted = None
+
+        # region indexes for fast magic wand selections are built by a scheduler of
+        # their own so they never hold up edits, see prepare_regions
+        self.indexer = JobScheduler(dispatch=lambda fn: Clock.schedule_once(lambda dt: fn()))
+        self.region_request = None
+
+        # saves are rendered and encoded on a thread of their own, see save_image_async
+        self.encoder = JobScheduler(dispatch=lambda fn: Clock.schedule_once(lambda dt: fn()))
+
+        # allow rotation, quarter turns are previewed with the rotate instruction
+        # while the rotated image is made, see change_rotation_async
         self.add(PushMatrix())
-        self.rotate = Rotate(angle = 0)
+        self.rotate = Rotate(angle = 0, origin = (Window.width/2, Window.height/2))
         self.add(self.rotate)
 
+        # texture is reused between updates, upload_times holds recent upload durations
+        # texture_image is the image currently uploaded into texture
+        self.texture = None
+        self.texture_image = None
+        self.shown = None
+        self.upload_times = deque(maxlen=120)
+
+        # images too big for one texture are drawn as tiles in their own group
+        # instead of the rectangle, only tiles on screen are uploaded, see show_tiles
+        self.tiles = InstructionGroup()
+        self.tiled = False
+        self.tile_cache = LRUCache(TILE_CACHE_BYTES, size_of=texture_bytes)
+
         # create rectangle to hold image
         self.rectangle = Rectangle(pos=pos, size=size)
+        self.add(self.rectangle)
+        self.add(self.tiles)
+
+        # selections are shown as a translucent mask texture above the image rather
+        # than painted into it, the group is empty while no selection is shown
+        self.selection = InstructionGroup()
+        self.selection_color = Color(rgba=(1, 0, 0, .5))
+        self.selection_rectangle = Rectangle(pos=pos, size=size)
+        self.selection_texture = None
+        self.selection_mask = None
+        self.add(self.selection)
         self.add(PopMatrix())
         self.on_update()
-        self.add(self.rectangle)
+
+    # call once the picture is no longer shown: stops its background threads, saves
+    # already queued still finish, and drops its caches and history
+    def close(self):
+        self.jobs.close()
+        self.committing = None
+        self.indexer.close()
+        self.encoder.close(finish=True)
+        self.pyramids.clear()
+        self.preview_cache.clear()
+        self.tile_cache.clear()
+        self.history.close()
 
     def update_filepath(self, new_filepath):
-        im = Image.open(new_filepath).convert("RGBA")
-        self.image = im.copy()
-        self.temp = im.copy()
-        self.filepath = new_filepath
+        self.settle()
+        size = self.session.open(new_filepath)
+        self.image_changed()
+        self.set_rectangle(*size)
+        self.on_update()
 
     def zoom_delta(self, delta_w=0, delta_h=0):
         ratio = min(delta_w/self.rectangle.size[0], delta_h/self.rectangle.size[1])
         self.rectangle.size = (self.rectangle.size[0]*(1+ratio), self.rectangle.size[1]*(1+ratio))
         self.on_layout((Window.width, Window.height))
+        # pick the pyramid level that matches the new zoom
+        self.on_update()
 
+    # images bigger than the window are shown through a pyramid level, see on_update
     def on_layout(self, win_size):
-        # TODO: add code to resize image if it is bigger than Window.width or Window.height
         self.rectangle.pos = (win_size[0] - self.rectangle.size[0])//2, (win_size[1] - self.rectangle.size[1])//2
-
+        self.rotate.origin = (win_size[0]/2, win_size[1]/2)
+        self.selection_rectangle.pos = self.rectangle.pos
+        if self.tiled:
+            self.on_update()
+
+    # uploads the preview (or temp if there is none) straight into the texture as raw rgba bytes
+    # temp is shown through the pyramid level that covers the rectangle, so the full
+    # resolution is only uploaded when zoomed in past every level
+    # a crop view only changes which part of the texture the rectangle shows
+    # images are never modified in place, so an image that is already shown is skipped
     def on_update(self):
-        # convert PIL image to input for CoreImage
-        data = BytesIO()
-        self.temp.save(data, format='png')
-        data.seek(0)
+        start = time.perf_counter()
+        self.selection_rectangle.pos = self.rectangle.pos
+        self.selection_rectangle.size = self.rectangle.size
+        changes = None
+        view = None
+        if self.preview is None:
+            pyramid = self.get_pyramid(self.temp_image)
+            image = pyramid.select(self.view_size())
+            changes = pyramid.changes(image)
+            if self.view is not None:
+                scale_x, scale_y = image.size[0] / self.temp_image.size[0], image.size[1] / self.temp_image.size[1]
+                view = (self.view[0]*scale_x, self.view[1]*scale_y, self.view[2]*scale_x, self.view[3]*scale_y)
+        else:
+            image = self.preview
+
+        if max(image.size) > MAX_TEXTURE_SIZE:
+            self.show_tiles(image, changes, view)
+            return
+        if self.tiled:
+            self.tiles.clear()
+            self.insert(self.children.index(self.tiles), self.rectangle)
+            self.tiled = False
 
-        # update image
-        self.rectangle.texture = CoreImage(BytesIO(data.read()), ext='png').texture
+        if image is self.shown:
+            self.rectangle.tex_coords = box_tex_coords(image.size, view or (0, 0) + image.size)
+            return
+        self.shown = image
+        image = image if image.mode == 'RGBA' else image.convert('RGBA')
+
+        # after a local edit only the changed box is blitted over the old image
+        if changes is not None and changes[0] is self.texture_image:
+            left, top, right, bottom = changes[1]
+            if right > left and bottom > top:
+                self.texture.blit_buffer(image.crop(changes[1]).tobytes(), pos=(left, top), size=(right - left, bottom - top),
+                                         colorfmt='rgba', bufferfmt='ubyte')
+            self.texture_image = self.shown
+            self.rectangle.tex_coords = box_tex_coords(image.size, view or (0, 0) + image.size)
+            self.upload_times.append(time.perf_counter() - start)
+            return
 
-    # saves the image
-    def save_image(self, extra=""):
-        path_without_extension = os.path.splitext(self.filepath)[0]
-        new_path = path_without_extension + "_fotofix" + extra + ".png"
-        self.image.save(new_path)
+        # only allocate a new texture when the image size changes
+        if self.texture is None or tuple(self.texture.size) != image.size:
+            self.texture = Texture.create(size=image.size, colorfmt='rgba', bufferfmt='ubyte')
+            # PIL rows go top to bottom but texture rows go bottom to top
+            self.texture.flip_vertical()
+
+        self.texture.blit_buffer(image.tobytes(), colorfmt='rgba', bufferfmt='ubyte')
+        self.texture_image = self.shown
+        self.rectangle.texture = self.texture
+        self.rectangle.tex_coords = box_tex_coords(image.size, view or (0, 0) + image.size)
+        self.upload_times.append(time.perf_counter() - start)
+
+    # size the whole of temp takes up on screen, bigger than the rectangle when it shows a crop view
+    def view_size(self):
+        width, height = self.rectangle.size
+        if self.view is None:
+            return width, height
+        left, top, right, bottom = self.view
+        return width * self.temp_image.size[0] / (right - left), height * self.temp_image.size[1] / (bottom - top)
+
+    # draws image as a grid of texture tiles laid over the rectangle
+    # tiles outside the window are skipped, uploaded tiles are kept in tile_cache
+    # so panning and zooming back to an image that was shown before is free
+    # called on every on_update since the rectangle may have moved
+    # changes is (old image, box) when image only differs from old image inside box,
+    # then tiles of old image are reused and only the box is blitted into them
+    # view is the box of image the rectangle shows, by default all of it
+    def show_tiles(self, image, changes=None, view=None):
+        start = time.perf_counter()
+        if not self.tiled:
+            self.remove(self.rectangle)
+            self.tiled = True
+        self.shown = image
+        self.tiles.clear()
+
+        view = view or (0, 0) + image.size
+        (x0, y0), (width, height) = self.rectangle.pos, self.rectangle.size
+        scale_x, scale_y = width / (view[2] - view[0]), height / (view[3] - view[1])
+        uploaded = 0
+        for box in tile_boxes(image.size, TEXTURE_TILE_SIZE):
+            left, top, right, bottom = box
+            part = intersect_box(box, view)
+            if part is None:
+                continue
+            # texture y goes up from the bottom of the rectangle
+            pos = (x0 + (part[0] - view[0])*scale_x, y0 + (view[3] - part[3])*scale_y)
+            size = ((part[2] - part[0])*scale_x, (part[3] - part[1])*scale_y)
+            if pos[0] + size[0] < 0 or pos[1] + size[1] < 0 or pos[0] > Window.width or pos[1] > Window.height:
+                continue
 
-    # undo the change
-    def undo(self):
-        if self.history_pos > 0:
-            self.history_pos -= 1
-            assert self.history_pos >= 0
+            key = (id(image), left, top)
+            cached = self.tile_cache.get(key)
+            if cached is None or cached[0]() is not image:
+                cached = self.patch_tile(image, box, changes)
+                if cached is None:
+                    cached = (weakref.ref(image), make_texture(image.crop(box)))
+                self.tile_cache.put(key, cached)
+                uploaded += 1
+            tile = Rectangle(texture=cached[1], pos=pos, size=size)
+            tile.tex_coords = box_tex_coords((right - left, bottom - top), (part[0] - left, part[1] - top, part[2] - left, part[3] - top))
+            self.tiles.add(tile)
+
+        if uploaded:
+            self.upload_times.append(time.perf_counter() - start)
+
+    # returns the tile cache entry of image at box made from the tile of the old image
+    # in changes, or None if that tile was not uploaded
+    def patch_tile(self, image, box, changes):
+        if changes is None:
+            return None
+        old, changed = changes
+        key = (id(old), box[0], box[1])
+        cached = self.tile_cache.get(key)
+        if cached is None or cached[0]() is not old:
+            return None
+
+        region = intersect_box(box, changed)
+        if region is None:
+            return (weakref.ref(image), cached[1])
+        # the texture now belongs to image, so the old image cannot use it anymore
+        self.tile_cache.pop(key)
+        cached[1].blit_buffer(image.crop(region).tobytes(), pos=(region[0] - box[0], region[1] - box[1]),
+                              size=(region[2] - region[0], region[3] - region[1]), colorfmt='rgba', bufferfmt='ubyte')
+        return (weakref.ref(image), cached[1])
+
+    # average time in seconds of the recent texture uploads
+    def average_upload_time(self):
+        if not self.upload_times:
+            return 0
+        return sum(self.upload_times) / len(self.upload_times)
+
+    # returns the smallest proxy of image that covers the rectangle on screen
+    # falls back to the full resolution image when zoomed in past every proxy
+    def get_proxy(self):
+        return self.get_pyramid(self.image).select(self.rectangle.size)
+
+    # returns the pyramid of image, the most recently used PYRAMIDS are kept
+    def get_pyramid(self, image):
+        cached = self.pyramids.get(id(image))
+        if cached is None or cached.image is not image:
+            cached = Pyramid(image, (Window.width, Window.height))
+        self.put_pyramid(cached)
+        return cached
+
+    def put_pyramid(self, pyramid):
+        self.pyramids[id(pyramid.image)] = pyramid
+        self.pyramids.move_to_end(id(pyramid.image))
+        while len(self.pyramids) > PYRAMIDS:
+            self.pyramids.popitem(last=False)
+
+    # called by the session after a local edit, image only differs from previous inside box
+    # the pyramid of image is patched from the one of previous instead of being rebuilt
+    def patch_pyramid(self, previous, image, box):
+        self.put_pyramid(self.get_pyramid(previous).patch(image, box))
+
+    # previews a slider edit by running render(image, factor) on the proxy
+    # the full resolution result is only computed by render_pending
+    def preview_edit(self, mode, factor, render):
+        self.settle()
+        proxy = self.get_proxy()
+        key = (self.version, proxy.size, mode, quantize(factor, PREVIEW_STEP))
+
+        # nothing to do if the slider has not moved since the last preview
+        if self.pending is not None and self.preview_key == key:
+            self.pending = (mode, factor, render)
+            return
 
-            image, width, height = self.history[self.history_pos]
+        self.pending = (mode, factor, render)
+        self.preview_key = key
 
-            self.image = image
-            self.temp = image
+        preview = self.preview_cache.get(key)
+        if preview is not None:
+            self.preview = preview
+            return
 
-            # update size of rectangle
-            self.rectangle.pos = (Window.width - width)//2, (Window.height - height)//2
-            self.rectangle.size=(width, height)
+        # render in the background, only the newest slider value gets shown
+        def install(preview):
+            self.preview_cache.put(key, preview)
+            if self.preview_key == key:
+                self.preview = preview
+                self.on_update()
+
+        self.jobs.submit('preview', lambda: render(proxy, key[3]), install)
+
+    # renders the pending slider edit into temp at full resolution
+    def render_pending(self):
+        if self.pending is not None:
+            self.session.render_edit(*self.pending)
+        self.discard_pending()
+
+    # drops the pending slider edit and its preview
+    def discard_pending(self):
+        self.pending = None
+        self.preview = None
+        self.preview_key = None
+
+    # call after self.image is replaced, cached previews of the old image are dropped
+    # and so is a threshold preview, its seed and selection were on the old image
+    def image_changed(self):
+        self.preview_cache.clear()
+        self.discard_pending()
+        self.end_threshold_preview()
+        self.indexer.cancel('regions')
+        self.region_request = None
+
+    # starts building the region index of image in the background, unless it was built
+    # call it when the magic wand is about to be used, later selections are then fast
+    def prepare_regions(self):
+        # the image is about to change, the index is built for the one after
+        if self.committing is not None:
+            self.regions_wanted = True
+            return
+        source = self.image
+        if self.session.has_regions(source) or self.region_request is source:
+            return
+        self.region_request = source
+
+        def install(index):
+            if self.region_request is source:
+                self.region_request = None
+                self.region_index = (source, index)
+
+        self.indexer.submit('regions', lambda: index_regions(np.asarray(source)), install)
+
+    def render_log(self, size=None):
+        self.settle()
+        return self.session.render_log(size)
+
+    def save_image(self, extra="", preset='png'):
+        self.settle()
+        return self.session.save_image(extra, preset)
+
+    # save_image on the encoder thread, from the edit log as it is when called
+    # done(result of save_render) or failed(error) is called on the main thread after
+    def save_image_async(self, extra="", preset='png', done=None, failed=None):
+        self.settle()
+        path = save_path(self.filepath, extra, preset)
+        original, ops = self.original, self.ops
+        self.encode_async(lambda: save_render(original, ops, path, preset), self.session.record_save, path, done, failed)
+
+    def export(self, targets=EXPORT_SIZES, directory=None):
+        self.settle()
+        return self.session.export(targets, directory)
+
+    # export on the encoder thread, from the edit log as it is when called
+    # done(result of export_render) or failed(error) is called on the main thread after
+    def export_async(self, targets=EXPORT_SIZES, directory=None, done=None, failed=None):
+        self.settle()
+        original, ops, filepath = self.original, self.ops, self.filepath
+        self.encode_async(lambda: export_render(original, ops, filepath, targets, directory), self.session.record_export, filepath, done, failed)
+
+    # runs save() on the encoder thread, then record(result) and done(result) on the
+    # main thread, or failed(error) if save raised
+    def encode_async(self, save, record, name, done=None, failed=None):
+        def work():
+            try:
+                return save(), None
+            except Exception as e:
+                return None, e
+
+        def install(outcome):
+            result, error = outcome
+            if error is not None:
+                print("saving %s failed: %s" % (name, error))
+                if failed is not None:
+                    failed(error)
+                return
+            record(result)
+            if done is not None:
+                done(result)
+
+        self.encoder.submit(None, work, install)
 
-        else:
-            print("Can't undo anymore")
+    # undo the change
+    def undo(self):
+        self.settle()
+        size = self.session.undo()
+        if size is not None:
+            self.image_changed()
+            self.set_rectangle(*size)
 
     # redo the change
     def redo(self):
-        if self.history_pos < len(self.history)-1:
-            self.history_pos += 1
-            assert self.history_pos < len(self.history)
-
-            image, width, height = self.history[self.history_pos]
-
-            self.image = image
-            self.temp = image
+        self.settle()
+        size = self.session.redo()
+        if size is not None:
+            self.image_changed()
+            self.set_rectangle(*size)
 
-            # update size of rectangle
-            self.rectangle.pos = (Window.width - width)//2, (Window.height - height)//2
-            self.rectangle.size=(width, height)
-
-        else:
-            print("Can't redo anymore")
+    # centers the rectangle in the window at width x height
+    def set_rectangle(self, width, height):
+        self.rectangle.pos = (Window.width - width)//2, (Window.height - height)//2
+        self.rectangle.size = (width, height)
 
     # update the image and history
+    # a pending slider edit is committed in the background, see commit_pending
     def update(self):
-        if self.history_pos < len(self.history)-1: # at old state
-            # keep history up to current state
-            self.history = self.history[:self.history_pos + 1]
-
-        self.history.append((self.temp, self.rectangle.size[0], self.rectangle.size[1]))
-        self.image = self.temp
-
-        self.history_pos += 1
-        print(len(self.history))
-        assert self.history_pos < len(self.history)
-        assert self.history_pos >= 0
+        if self.pending is not None:
+            self.commit_pending()
+            return
+        self.settle()
+        self.session.update(self.rectangle.size[0], self.rectangle.size[1])
+        self.image_changed()
+
+    # renders the pending slider edit at full resolution on the job thread, its
+    # preview stays on screen until the result is installed and added to the history
+    def commit_pending(self):
+        self.settle()
+        mode, factor, render = self.pending
+        self.pending = None
+        source = self.image
+        rendered = []
+
+        def install(result):
+            self.settle()
+            self.on_update()
+
+        job = self.jobs.submit('commit', lambda: rendered.append(render(source, factor)), install)
+        self.committing = (source, mode, factor, rendered, job)
+
+    # installs the slider edit being committed, waiting for it if it is not rendered yet
+    # call before anything reads or changes image or temp
+    def settle(self):
+        if self.committing is None:
+            return
+        source, mode, factor, rendered, job = self.committing
+        self.committing = None
+        job.wait()
+        if not rendered or self.image is not source:
+            print("Could not commit %s" % mode)
+            self.discard_pending()
+            return
+        self.session.install_edit(mode, factor, rendered[0])
+        self.update_installed()
+        if self.regions_wanted:
+            self.regions_wanted = False
+            self.prepare_regions()
+
+    # update the image and history with a temp installed by a background edit
+    # a slider edit still pending was previewed on the image before it, so it is
+    # previewed again on the new image rather than rendered over the new temp
+    def update_installed(self):
+        pending = self.pending
+        self.session.update(self.rectangle.size[0], self.rectangle.size[1])
+        self.image_changed()
+        if pending is not None:
+            self.preview_edit(*pending)
 
     # display the image in the iamge viewer
     def show(self):
-        self.temp.show()
+        self.settle()
+        self.render_pending()
+        self.session.show()
 
     # change the brightness by factor
     # factor > 1: brighter
@@ -152,9 +565,7 @@ class Picture(InstructionGroup):
     # factor = 0: black
     def change_brightness(self, factor):
         assert factor >= 0
-        enhancer = ImageEnhance.Brightness(self.image)
-        result = enhancer.enhance(factor)
-        self.temp = result
+        self.preview_edit('brightness', factor, self.session.render_brightness)
 
     # change the contrast by factor
     # factor > 1: more contrast
@@ -162,12 +573,11 @@ class Picture(InstructionGroup):
     # factor = 0: gray
     def change_contrast(self, factor):
         assert factor >= 0
-        enhancer = ImageEnhance.Contrast(self.image)
-        result = enhancer.enhance(factor)
-        self.temp = result
+        self.preview_edit('contrast', factor, self.session.render_contrast)
 
     # crops the image by the specified amount in each direction
     def crop(self, l=0, t=0, r=0, b=0):
+        self.settle()
         view_width, view_height = self.rectangle.size
         width, height = self.image.size
 
@@ -178,182 +588,178 @@ class Picture(InstructionGroup):
         bottom = b/view_height*height
 
         # change borders
-        right = width - right
-        bottom = height - bottom
-        borders = (left, top, right, bottom)
-
-        # apply the crop
-        result = self.image.crop(borders)
-        self.temp = result
+        self.session.crop(left, top, width - right, height - bottom)
 
         # update size of rectangle
-        w, h = (self.rectangle.size[0] - r - l, self.rectangle.size[1] - t - b)
-        self.rectangle.pos = (Window.width - w)//2, (Window.height - h)//2
-        self.rectangle.size=(w, h)
+        self.set_rectangle(self.rectangle.size[0] - r - l, self.rectangle.size[1] - t - b)
 
-    # applies a sticker centered on (x, y) in the image
+    # applies a sticker centered on (x, y) in the rectangle
     # stickerfp is the filepath of the sticker
     def add_sticker(self, stickerfp, x, y):
-
+        self.settle()
         # convert x, y from rectangle coordinate (might be modified by zoom) to image coordinates
         view_width, view_height = self.rectangle.size
         width, height = self.image.size
-        x = int(width * x/view_width)
-        y = int(height * y/view_height)
-
-        sticker = Image.open(stickerfp).convert("RGBA")
-        w, h = sticker.size
-
-        # paste uses top left corner, so we need to offset to place in the center
-        new_x, new_y = x - (w//2), y - (h//2)
-        assert(new_x >= 0)
-        assert(new_y >= 0)
-
-        location = (new_x, new_y)
-        copy = self.temp.copy()
-        copy.paste(sticker, location, sticker)
-        self.temp = copy
+        self.session.add_sticker(stickerfp, int(width * x/view_width), int(height * y/view_height))
 
     # selects all neighboring pixels with the same color as (x, y) with threshold
-    # returns a mask array of 0s and 1s where 0 is an unselected pixel and 1 is selected
-    # not done yet its complicated
+    # returns an (h, w) boolean mask where True marks a selected pixel
     def magic_wand(self, x, y, threshold = .5):
+        return self.session.magic_wand(*self.image_coords(x, y), threshold)
+
+    # converts x, y from rectangle coordinates (might be modified by zoom) to a pixel of temp
+    def image_coords(self, x, y):
+        self.settle()
         view_width, view_height = self.rectangle.size
         width, height = self.image.size
-        x = int(width * x/view_width)
-        y = int(height * y/view_height)
-
-        img_data = self.temp.getdata()
-        output = np.zeros(len(img_data)).tolist()
-
         w, h = self.temp.size
-        selected_color = get_color(img_data, x, y, w)
-
-        stack = [(x, x, y)] # rows to work through, list of [left bound, right bound, y]
-        done = set() # finished rows
-
-        # function to check if point already in bitmap
-        def is_in_bitmap(xi, yi):
-            return output[get_index(xi, yi, w)] == 1
-
-        # function to get row segment given point and add to bitmap
-        def get_row(xi, yi):
-            curr_x = xi
-            left, right = xi, xi # bounds of the color row
-            color = get_color(img_data, curr_x, yi, w)
-
-            # check left
-            while curr_x >= 0:
-                color = get_color(img_data, curr_x, yi, w)
-                if is_similar_color(selected_color, color, threshold):
-                    output[get_index(curr_x, yi, w)] = 1    # update the bitmap
-                    left = curr_x                          # set new left bound
-                    curr_x -= 1                             # try pixel to the left
-                else:
-                    break
-
-            # reset iterating values
-            curr_x = xi
-            color = get_color(img_data, curr_x, yi, w)
-
-            # check right
-            while curr_x < w:
-                color = get_color(img_data, curr_x, yi, w)
-                if is_similar_color(selected_color, color, threshold):
-                    output[get_index(curr_x, yi, w)] = 1    # update the bitmap
-                    right = curr_x                          # set new right bound
-                    curr_x += 1                             # try pixel to the right
-                else:
-                    break
-
-            return (left, right, yi)
-
-        # work through stack of rows to find all connected points
-        while stack:
-            # print(stack)
-            row = stack.pop()
-            if row in done:
-                continue
-            else:
-                done.add(row)
-
-            left, right, curr_y = row
-            above = curr_y - 1
-            below = curr_y + 1
-
-            # check above and below for each point in row
-            for x in range(left, right+1):
-                # check above
-                if (above >= 0
-                    and is_similar_color(selected_color, get_color(img_data, x, above, w), threshold)
-                    and not is_in_bitmap(x, above)):
-
-                    new_row = get_row(x, above)
-                    if new_row in done:
-                        continue
-                    else:
-                        stack.append(new_row)
-
-                # check below
-                if (below < h
-                    and is_similar_color(selected_color, get_color(img_data, x, below, w), threshold)
-                    and not is_in_bitmap(x, below)):
-
-                    new_row = get_row(x, below)
-                    if new_row in done:
-                        continue
-                    else:
-                        stack.append(new_row)
-
-        return output
+        x = min(max(int(width * x/view_width), 0), w - 1)
+        y = min(max(int(height * y/view_height), 0), h - 1)
+        return x, y
 
     # selects all similar colored pixels
-    # returns a mask array of 0s and 1s where 0 is an unselected pixel and 1 is selected
+    # returns an (h, w) boolean mask where True marks a selected pixel
     def select_similar_pixels(self, x, y, threshold = .5):
-        # convert x, y from rectangle coordinate (might be modified by zoom) to image coordinates
-        view_width, view_height = self.rectangle.size
-        width, height = self.image.size
-        x = int(width * x/view_width)
-        y = int(height * y/view_height)
+        return self.session.select_similar_pixels(*self.image_coords(x, y), threshold)
 
-        img_data = self.temp.getdata()
-        output = np.zeros(len(img_data)).tolist()
-
-        w, __ = self.temp.size
-        selected_color = get_color(img_data, x, y, w)
-
-        for i in range(len(img_data)):
-            color = img_data[i]
-            if is_similar_color(color, selected_color, threshold):
-                output[i] = 1
-
-        return output
-
-    # makes all pixels that are labelled 1 in mask transparent
+    # makes all pixels that are selected in mask transparent
     def make_transparent(self, mask):
-        new_data = []
-        img_data = self.temp.getdata()
-
-        for i in range(len(mask)):
-            if mask[i]:
-                new_data.append((255, 255, 255, 0))
+        self.settle()
+        self.session.make_transparent(mask)
+
+    # magic_wand at (x, y) followed by make_transparent, run in the background
+    # the result is shown and added to the history once it is done, unless temp
+    # was changed in the meantime; a newer request replaces one still running
+    def make_transparent_async(self, x, y, threshold = .5):
+        self.make_transparent_pixel_async(*self.image_coords(x, y), threshold)
+
+    # make_transparent_async seeded at pixel (x, y) of temp
+    def make_transparent_pixel_async(self, x, y, threshold = .5):
+        self.settle()
+        source = self.temp
+        regions = self.session.get_regions(source)
+
+        def work():
+            data = np.array(source)
+            if regions is not None:
+                mask = regions.select(x, y, threshold)
             else:
-                new_data.append(img_data[i])
-
-        self.temp.putdata(new_data)
-
-    # makes all pixels that are labelled 1 in mask bright red
-    def highlight_pixel(self, mask):
-        new_data = []
-        img_data = self.temp.getdata()
+                mask = flood_fill_mask(data, x, y, threshold)
+            fill_mask(data, mask, (255, 255, 255, 0))
+            return mask, Image.fromarray(data, 'RGBA'), mask_box(mask)
+
+        def install(result):
+            if self.temp is not source:
+                return
+            mask, image, box = result
+            self.session.set_temp_local(image, box)
+            self.temp_ops = self.temp_ops + [('transparent', np.packbits(mask), mask.shape)]
+            self.update_installed()
+            self.on_update()
+            # more clicks usually follow
+            self.prepare_regions()
+
+        self.jobs.submit('transparent', work, install)
+
+    # starts a live preview of what make_transparent_async(x, y, threshold) selects
+    # thresholds are flood filled on the proxy on screen in the background, and every
+    # selection is cached, so moving the slider back shows it right away
+    def start_threshold_preview(self, x, y, threshold = .5):
+        self.settle()
+        seed = self.image_coords(x, y)
+        source = self.temp
+        proxy = self.get_pyramid(source).select(self.rectangle.size)
+        x = min(seed[0] * proxy.size[0] // source.size[0], proxy.size[0] - 1)
+        y = min(seed[1] * proxy.size[1] // source.size[1], proxy.size[1] - 1)
+        self.threshold_request = (source, proxy, x, y, seed)
+        self.threshold_masks.clear()
+        self.preview_threshold(threshold)
+
+    # highlights the pixels the threshold preview selects at threshold
+    # only the newest threshold is filled, ones the slider has already moved past are dropped
+    def preview_threshold(self, threshold):
+        request = self.threshold_request
+        if request is None or request[0] is not self.temp:
+            return
+        source, proxy, x, y, seed = request
+        threshold = quantize(threshold, PREVIEW_STEP)
+        self.threshold_wanted = threshold
+        mask = self.threshold_masks.get(threshold)
+        if mask is not None:
+            self.show_selection(mask)
+            return
 
-        for i in range(len(mask)):
-            if mask[i]:
-                new_data.append((255, 0, 0, 255))
-            else:
-                new_data.append(img_data[i])
+        def install(mask):
+            if self.threshold_request is not request:
+                return
+            self.threshold_masks.put(threshold, mask)
+            if self.threshold_wanted == threshold:
+                self.show_selection(mask)
+
+        self.jobs.submit('threshold', lambda: flood_fill_mask(np.asarray(proxy), x, y, threshold), install)
+
+    # ends the threshold preview and makes what it selects at threshold transparent,
+    # seeded where the preview started rather than wherever the hand is now
+    def apply_threshold_preview(self, threshold):
+        request = self.threshold_request
+        self.end_threshold_preview()
+        if request is None or request[0] is not self.temp:
+            print("Nothing previewed to apply")
+            return
+        self.make_transparent_pixel_async(*request[4], threshold)
 
-        self.temp.putdata(new_data)
+    def end_threshold_preview(self):
+        if self.threshold_request is None:
+            return
+        self.jobs.cancel('threshold')
+        self.threshold_request = None
+        self.threshold_masks.clear()
+        self.threshold_wanted = None
+        self.hide_selection()
+
+    # shows the pixels that are selected in mask in bright red, without changing temp
+    # a strength below 1 tints them instead, keeping some of the image visible
+    def highlight_pixel(self, mask, strength=1.0):
+        mask = as_mask(mask, (self.temp_image.size[1], self.temp_image.size[0]))
+        self.show_selection(mask, (1, 0, 0, strength))
+
+    # shows mask as a translucent color over the image
+    # the mask is uploaded at no more than the resolution on screen, and when the
+    # previous mask had the same size only the box where they differ is uploaded
+    def show_selection(self, mask, color=(1, 0, 0, .5)):
+        size = self.get_pyramid(self.temp_image).select(self.view_size()).size
+        size = fit_size(size, (min(size[0], mask.shape[1]), min(size[1], mask.shape[0])))
+        size = fit_size(size, (MAX_TEXTURE_SIZE, MAX_TEXTURE_SIZE))
+        if (mask.shape[1], mask.shape[0]) != size:
+            mask = np.asarray(Image.fromarray(mask).resize(size, Image.NEAREST))
+
+        texture = self.selection_texture
+        if texture is None or tuple(texture.size) != size or self.selection_mask is None:
+            texture = Texture.create(size=size, colorfmt='luminance_alpha', bufferfmt='ubyte')
+            # PIL rows go top to bottom but texture rows go bottom to top
+            texture.flip_vertical()
+            box = (0, 0) + size
+        else:
+            box = mask_box(mask != self.selection_mask)
+
+        # the mask goes into both channels, so unselected pixels are fully transparent
+        left, top, right, bottom = box
+        if right > left and bottom > top:
+            region = np.repeat(mask[top:bottom, left:right, None], 2, axis=2).astype(np.uint8) * 255
+            texture.blit_buffer(region.tobytes(), pos=(left, top), size=(right - left, bottom - top),
+                                colorfmt='luminance_alpha', bufferfmt='ubyte')
+
+        self.selection_texture = texture
+        self.selection_mask = mask
+        self.selection_color.rgba = color
+        self.selection_rectangle.texture = texture
+        if not self.selection.children:
+            self.selection.add(self.selection_color)
+            self.selection.add(self.selection_rectangle)
+
+    def hide_selection(self):
+        self.selection.clear()
+        self.selection_mask = None
 
     # change the saturation by factor
     # factor > 1: more saturation
@@ -361,9 +767,7 @@ class Picture(InstructionGroup):
     # factor = 0: black and white
     def change_saturation(self, factor):
         assert factor >= 0
-        enhancer = ImageEnhance.Color(self.image)
-        result = enhancer.enhance(factor)
-        self.temp = result
+        self.preview_edit('saturation', factor, self.session.render_saturation)
 
     # change the sharpness by factor
     # factor = 2: sharpened
@@ -371,109 +775,78 @@ class Picture(InstructionGroup):
     # factor = 0: blurry
     def change_sharpness(self, factor):
         assert factor >= 0
-        enhancer = ImageEnhance.Sharpness(self.image)
-        result = enhancer.enhance(factor)
-        self.temp = result
+        self.preview_edit('sharpness', factor, self.session.render_sharpness)
 
     # rotate the image by angle degrees
     # if update_dims, update image dimensions to fit rotated image
     # else image is cropped to original size
     def change_rotation(self, angle=90, update_dims=True):
-        result = self.image.rotate(angle, expand=update_dims)
-        # if not update_dims:
-        #     print(angle)
-        #     self.rotate.angle += angle
-        #     self.rotate.angle %= 360
-        # if update_dims and angle==90:
-        new_width = self.rectangle.size[1]
-        new_height = self.rectangle.size[0]
-        self.rectangle.pos = (Window.width - new_width)//2, (Window.height - new_height)//2
-        self.rectangle.size = (new_width, new_height)
-        self.temp = result
-
-    # Sets all the pixels in square given by coord x,y
-    # and size w,h to the avg pixel color
-    def make_pixel(self, x, y, h, w):
-        width, height = self.image.size
-        img_data = self.image.getdata()
-        pixels = []
-
-        # get all pixels
-        for j, i in pixels_from_square(x, y, h, w, height, width):
-            index = get_index(i, j, width)
-            pixels.append(img_data[index])
-
-        if len(pixels) == 0:
-            # can't seem to find the reason why this happens,
-            # but doing this doesn't affect the image...?
-            return
-
-        # get the average color
-        avg_r, avg_g, avg_b = 0, 0, 0
-        for r, g, b, _ in pixels:
-            avg_r += r
-            avg_g += g
-            avg_b += b
-        avg_r //= len(pixels)
-        avg_g //= len(pixels)
-        avg_b //= len(pixels)
-
-        # set all pixels to that average color
-        for j, i in pixels_from_square(x, y, h, w, height, width):
-            index = get_index(i, j, width)
-            alpha = img_data[index][3]
-            self.temp.putpixel((i, j), (avg_r, avg_g, avg_b, alpha))
+        self.settle()
+        self.session.change_rotation(angle, update_dims)
+        self.swap_rectangle()
+
+    # swaps the width and height of the rectangle, for 90 degree rotations
+    def swap_rectangle(self):
+        self.set_rectangle(self.rectangle.size[1], self.rectangle.size[0])
+
+    # change_rotation followed by update, with the rotation run in the background
+    # rotations requested while one is still running are added up into a single one
+    # quarter turns show up right away by turning the rectangle with the rotate
+    # instruction, the texture is only replaced once the rotated image is ready
+    def change_rotation_async(self, angle=90, update_dims=True):
+        self.settle()
+        source = self.image
+        turns = 1
+        if self.rotation_request is not None and self.rotation_request[0] is source:
+            angle += self.rotation_request[1]
+            turns += self.rotation_request[2]
+        request = (source, angle, turns)
+        self.rotation_request = request
+        if angle % 90 == 0:
+            self.rotate.angle = angle % 360
+
+        def install(result):
+            # compared by identity, == would compare the pixels of the images in them
+            if self.rotation_request is not request:
+                return
+            self.rotation_request = None
+            self.rotate.angle = 0
+            if self.image is not source:
+                return
+            for _ in range(turns % 2):
+                self.swap_rectangle()
+            self.temp = result
+            self.temp_ops = [('rotate', angle, update_dims)]
+            self.update_installed()
+            self.on_update()
+
+        self.jobs.submit('rotate', lambda: rotate_image(source, angle, update_dims), install)
 
     # pixelates the image
     # factor = 1: image is one giant pixel (subject to aspect ratio)
     # factor = 0: image is normal
     def pixelate(self, factor):
-        if factor == 0:
-            self.temp = self.image
-
-        width, height = self.image.size
-
-        # scale factor between 0.3 and 0.7
-        factor = factor * (0.7 - 0.3) + 0.3
-
-        # math to work out the pixelation factor, feel free to make this prettier
-        num_cols = int(max(round((1 - factor) * width), 1))
-        square_w = round(width / num_cols)
-        num_rows = int(max(round((1 - factor) * height), 1))
-        square_h = round(height / num_rows)
-
-        # padding in case not all pixels are covered by rounding
-        if square_w * num_cols < width:
-            num_cols += 1
-        if square_h * num_rows < height:
-            num_rows += 1
-
-        # overwrite each square with the average color, one by one
-        for row in range(num_rows):
-            for col in range(num_cols):
-                self.make_pixel(row, col, square_h, square_w)
+        self.preview_edit('pixelate', factor, self.session.render_pixelate)
 
-    # inverts the colors on the image
+    # inverts the colors on the image, keeping transparency
     def invert(self):
-        copy = self.temp.copy().convert('RGB')
-        new = ImageOps.invert(copy)
-        new.convert("RGBA")
-        self.temp = new
+        self.settle()
+        self.session.invert()
 
-    # converts colors to grayscale
+    # converts colors to grayscale, keeping transparency
     def grayscale(self):
-        copy = self.temp.copy().convert('RGB')
-        new = ImageOps.grayscale(copy)
-        new.convert("RGBA")
-        self.temp = new
+        self.settle()
+        self.session.grayscale()
 
     # returns true if edit state is at the beginning of the history, else false
     def is_original_image(self):
-        return self.history_pos == 0
+        self.settle()
+        return self.session.is_original_image()
 
     # returns true if edit state is at the end of the history, else false
     def is_latest_image(self):
-        return self.history_pos == (len(self.history) - 1)
+        self.settle()
+        return self.session.is_latest_image()
 
 # test = Picture("images/test_image.jpg")
 # test.pixelate(.99)
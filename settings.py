@@ -10,6 +10,7 @@ from kivy.uix.label import Label
 
 from hand import Hand, kLeapRange, update_window_size, get_window_size
 import photo_editor
+from engine import SAVE_PRESETS
 
 class Settings(Screen) :
     def __init__(self, **kwargs):
@@ -79,6 +80,16 @@ class Settings(Screen) :
         self.add_widget(self.tt_value_label)
         self.tt_timer = None
 
+        self.save_format_label = Label(text='Save Format', font_name='./fonts/Cairo-Regular', color=(63/255, 127/255, 191/255, 1))
+        self.add_widget(self.save_format_label)
+        self.sf_down_button = SensorButton(mode='hover', texture=CoreImage('icons/down.png').texture)
+        self.sf_up_button = SensorButton(mode='hover', texture=CoreImage('icons/up.png').texture)
+        self.canvas.add(self.sf_down_button)
+        self.canvas.add(self.sf_up_button)
+        self.sf_value_label = Label(text=photo_editor.save_preset, font_name='./fonts/Cairo-Regular', color=(63/255, 127/255, 191/255, 1))
+        self.add_widget(self.sf_value_label)
+        self.sf_timer = None
+
         # Hand objects that represent and show palm positions
         self.hands = [Hand(1), Hand(2)]
         for h in self.hands:
@@ -152,6 +163,15 @@ class Settings(Screen) :
         self.tt_down_button.update_pos_and_size(pos=(5/8*Window.width-Window.width/40, 2*Window.height/10-Window.width/40), size=(Window.width/20, Window.width/20))
         self.tt_up_button.update_pos_and_size(pos=(6/8*Window.width-Window.width/40, 2*Window.height/10-Window.width/40), size=(Window.width/20, Window.width/20))
 
+        self.save_format_label.center_x = 3*Window.width/10
+        self.save_format_label.center_y = 1*Window.height/10
+        self.save_format_label.font_size = str(Window.width//60) + 'sp'
+        self.sf_value_label.center_x = 11/16*Window.width
+        self.sf_value_label.center_y = 1*Window.height/10
+        self.sf_value_label.font_size = str(Window.width//60) + 'sp'
+        self.sf_down_button.update_pos_and_size(pos=(5/8*Window.width-Window.width/40, 1*Window.height/10-Window.width/40), size=(Window.width/20, Window.width/20))
+        self.sf_up_button.update_pos_and_size(pos=(6/8*Window.width-Window.width/40, 1*Window.height/10-Window.width/40), size=(Window.width/20, Window.width/20))
+
         self.photo_editor_button.update_pos_and_size(pos=(0.02*Window.width, 0.98*Window.height-Window.width/15), size=(Window.width/15, Window.width/15))
 
 
@@ -172,6 +192,8 @@ class Settings(Screen) :
         self.vd_up_button2.on_update()
         self.tt_down_button.on_update()
         self.tt_up_button.on_update()
+        self.sf_down_button.on_update()
+        self.sf_up_button.on_update()
         self.photo_editor_button.on_update()
 
         screen_hands = list(filter(lambda h: not h.id == -1, self.hands))
@@ -192,6 +214,8 @@ class Settings(Screen) :
             self.vd_up_button2.set_screen_pos(screen_xy, norm_pt[2])
             self.tt_down_button.set_screen_pos(screen_xy, norm_pt[2])
             self.tt_up_button.set_screen_pos(screen_xy, norm_pt[2])
+            self.sf_down_button.set_screen_pos(screen_xy, norm_pt[2])
+            self.sf_up_button.set_screen_pos(screen_xy, norm_pt[2])
 
             if self.photo_editor_button.is_on and self.switch_to_timer == None:
                 self.switch_to_timer = time.time()
@@ -261,6 +285,19 @@ class Settings(Screen) :
             else:
                 self.tt_timer =  None
 
+            # steps through the save presets
+            self.sf_value_label.text = photo_editor.save_preset
+            if self.sf_down_button.is_on or self.sf_up_button.is_on:
+                if self.sf_timer == None:
+                    self.sf_timer = time.time()
+                elif time.time() - self.sf_timer > 1:
+                    self.sf_timer = None
+                    multiplier = -1 if self.sf_down_button.is_on else 1
+                    presets = list(SAVE_PRESETS)
+                    photo_editor.save_preset = presets[(presets.index(photo_editor.save_preset) + multiplier) % len(presets)]
+            else:
+                self.sf_timer =  None
+
         # update each hand
         for h in self.hands:
             h.on_update()
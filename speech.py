@@ -224,7 +224,10 @@ def process(responses, tts_client, voice, audio_config, stream, widget):
 
 
 def process_word(widget, audio_path, tts_client, voice, audio_config, mode, action=None):
-    if mode in ('sticker', 'transparent') and action:  # Handles audio for applying stickers/transparent background
+    if mode == 'transparent' and action in ('preview', 'up', 'down'):  # Threshold preview and tuning, no audio
+        widget.on_speech_recognized(action)
+
+    elif mode in ('sticker', 'transparent') and action:  # Handles audio for applying stickers/transparent background
         widget.on_speech_recognized(action)
         audio_fname = audio_path + 'apply_' + mode + '.mp3'
         play_audio_feedback(widget, audio_fname, tts_client, voice, audio_config, action=action)
@@ -245,6 +248,11 @@ def process_word(widget, audio_path, tts_client, voice, audio_config, mode, acti
             audio_fname = audio_path + mode.replace(' ', '_') + '.mp3'
         play_audio_feedback(widget, audio_fname, tts_client, voice, audio_config)
 
+    elif mode == 'replay':  # Applies the edits to the other photos in the background
+        widget.on_speech_recognized(mode)
+        audio_fname = audio_path + 'replay.mp3'
+        play_audio_feedback(widget, audio_fname, tts_client, voice, audio_config, action=mode)
+
     elif mode == 'rotate':
         if widget.mode == 'rotate':  # Check if in rotate mode
             audio_fname = audio_path + 'rotating.mp3'
@@ -277,7 +285,9 @@ def play_audio_feedback(widget, audio_fname, tts_client, voice, audio_config, ac
 def synthesize_audio(widget, audio_fname, tts_client, voice, audio_config, action=None, is_rotating=None):
     mode = widget.mode
     # Set the text input to be synthesized
-    if mode in edit_modes:
+    if action == 'replay':
+        text = "Applying your edits to the other photos"
+    elif mode in edit_modes:
         if mode == 'transparent':
             if action:
                 text = mode + " background has been added"